@@ -20,12 +20,16 @@ Save results and archive payloads with Azure Blob Storage
 
 """
 
+import asyncio
 import hashlib
 
 from datetime import datetime
-from azure.storage.blob.aio import BlobClient
+from collections import OrderedDict
+from typing import Dict, Optional, Union
 from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 
+from stoq import StoqPluginException
 from stoq.helpers import StoqConfigParser, dumps
 from stoq.plugins import ArchiverPlugin, ConnectorPlugin
 from stoq.data_classes import (
@@ -52,34 +56,41 @@ class AzureBlobPlugin(ArchiverPlugin, ConnectorPlugin):
         )
         self.use_sha = config.getboolean('options', 'use_sha', fallback=True)
         self.use_datetime = config.getboolean('options', 'use_datetime', fallback=False)
+        self.max_uploads = config.getint('options', 'max_uploads', fallback=16)
+        self.max_concurrency = config.getint('options', 'max_concurrency', fallback=4)
+        self.max_single_put_size = config.getint(
+            'options', 'max_single_put_size', fallback=8388608
+        )
+        self.max_block_size = config.getint(
+            'options', 'max_block_size', fallback=4194304
+        )
+        self.known_blobs_size = config.getint(
+            'options', 'known_blobs_size', fallback=100000
+        )
+        self._service: Optional[BlobServiceClient] = None
+        self._containers: Dict[str, ContainerClient] = {}
+        self._upload_slots: Optional[asyncio.Semaphore] = None
+        # Recently archived blob names, only used when blobs are named by sha1
+        self._known_blobs: 'OrderedDict[str, None]' = OrderedDict()
 
     async def save(self, response: StoqResponse) -> None:
         """
         Save response as Azure Blob Storage
 
         """
-        blob_client: BlobClient = BlobClient.from_connection_string(
-            conn_str=self.conn_str,
-            container_name=self.results_container,
-            blob_name=response.scan_id,
-        )
-        await blob_client.upload_blob(dumps(response))
-        await blob_client.close()
+        await self._upload(self.results_container, response.scan_id, dumps(response))
 
     async def get(self, task: ArchiverResponse) -> Payload:
         """
         Retrieve archived payload from Azure Blob Storage
 
         """
-        blob_client: BlobClient = BlobClient.from_connection_string(
-            conn_str=self.conn_str,
-            container_name=task.results['container_name'],
-            blob_name=task.results['blob_name'],
+        container = self._container(task.results['container_name'])
+        content = await container.download_blob(
+            task.results['blob_name'], max_concurrency=self.max_concurrency
         )
-        content = await blob_client.download_blob()
-        await blob_client.close()
         meta = PayloadMeta(task.results)
-        return Payload(content.readall(), meta)
+        return Payload(await content.readall(), meta)
 
     async def archive(self, payload: Payload, request: Request) -> ArchiverResponse:
         """
@@ -95,16 +106,58 @@ class AzureBlobPlugin(ArchiverPlugin, ConnectorPlugin):
         else:
             filename = payload.results.payload_id
 
-        blob_client: BlobClient = BlobClient.from_connection_string(
-            conn_str=self.conn_str,
-            container_name=self.archive_container,
-            blob_name=filename,
-        )
-        try:
-            await blob_client.upload_blob(payload.content)
-        except ResourceExistsError:
-            pass
-        await blob_client.close()
+        if not self.use_sha or not self._is_known(filename):
+            await self._upload(self.archive_container, filename, payload.content)
+            if self.use_sha:
+                self._remember(filename)
         return ArchiverResponse(
             {'container_name': self.archive_container, 'blob_name': filename}
         )
+
+    async def _upload(
+        self, container_name: str, blob_name: str, data: Union[bytes, str]
+    ) -> None:
+        """
+        Upload a blob, with at most max_uploads uploads in progress at once
+
+        Blobs larger than max_single_put_size are uploaded in blocks of
+        max_block_size, up to max_concurrency blocks at a time.
+
+        """
+        if self._upload_slots is None:
+            self._upload_slots = asyncio.Semaphore(self.max_uploads)
+        container = self._container(container_name)
+        async with self._upload_slots:
+            if self.use_sha and len(data) > self.max_single_put_size:
+                # Avoid staging every block of a large payload only for the
+                # commit to fail because the blob already exists
+                if await container.get_blob_client(blob_name).exists():
+                    return
+            try:
+                await container.upload_blob(
+                    blob_name, data, max_concurrency=self.max_concurrency
+                )
+            except ResourceExistsError:
+                pass
+
+    def _container(self, name: str) -> ContainerClient:
+        if self._service is None:
+            self._service = BlobServiceClient.from_connection_string(
+                self.conn_str,
+                max_single_put_size=self.max_single_put_size,
+                max_block_size=self.max_block_size,
+            )
+        if name not in self._containers:
+            self._containers[name] = self._service.get_container_client(name)
+        return self._containers[name]
+
+    def _is_known(self, blob_name: str) -> bool:
+        if blob_name in self._known_blobs:
+            self._known_blobs.move_to_end(blob_name)
+            return True
+        return False
+
+    def _remember(self, blob_name: str) -> None:
+        self._known_blobs[blob_name] = None
+        if len(self._known_blobs) > self.known_blobs_size:
+            self._known_blobs.popitem(last=False)
@@ -20,16 +20,22 @@ Save results to ElasticSearch
 
 """
 import json
+import time
+import atexit
+import asyncio
 import certifi
 
 from datetime import datetime
-from typing import Optional, Dict
-from elasticsearch import Elasticsearch
+from typing import Dict, List, Optional, Tuple
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from elasticsearch.exceptions import TransportError
 
 from stoq.plugins import ConnectorPlugin
 from stoq.helpers import StoqConfigParser
 from stoq.data_classes import StoqResponse
 
+RETRY_STATUSES = {429, 502, 503, 504}
+
 
 class ElasticSearchPlugin(ConnectorPlugin):
     def __init__(self, config: StoqConfigParser) -> None:
@@ -45,6 +51,22 @@ class ElasticSearchPlugin(ConnectorPlugin):
         self.index_by_month = config.getboolean(
             'options', 'index_by_month', fallback=True
         )
+        self.bulk = config.getboolean('options', 'bulk', fallback=False)
+        self.bulk_size = config.getint('options', 'bulk_size', fallback=500)
+        self.bulk_bytes = config.getint('options', 'bulk_bytes', fallback=10485760)
+        self.bulk_interval = config.getfloat('options', 'bulk_interval', fallback=5)
+        self.bulk_max_retries = config.getint('options', 'bulk_max_retries', fallback=3)
+        self._index: str = self.es_index
+        self._index_expires: float = 0
+        # Buffered documents as (index, serialized document, encoded size, attempts)
+        self._buffer: List[Tuple[str, str, int, int]] = []
+        self._buffer_bytes: int = 0
+        # Batches sent in a _bulk request that has not completed yet
+        self._in_flight: Dict[int, List[Tuple[str, str, int, int]]] = {}
+        self._flusher: Optional[asyncio.Future] = None
+        self._closer: Optional[asyncio.Future] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        atexit.register(self._flush_on_exit)
 
     async def save(self, response: StoqResponse) -> None:
         """
@@ -53,12 +75,165 @@ class ElasticSearchPlugin(ConnectorPlugin):
         """
         self._connect()
 
-        if self.index_by_month:
+        index = self._get_index()
+        if not self.bulk:
+            await self.es.index(index=index, doc_type=self.es_index, body=str(response))
+            return
+
+        doc = str(response)
+        size = len(doc.encode())
+        self._buffer.append((index, doc, size, 0))
+        self._buffer_bytes += size
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_periodically())
+        if len(self._buffer) >= self.bulk_size or self._buffer_bytes >= self.bulk_bytes:
+            await self._flush()
+
+    def _get_index(self) -> str:
+        """
+        Name of the index to save to, only rebuilt when the month changes
+
+        """
+        if self.index_by_month and time.time() >= self._index_expires:
             now = datetime.now()
-            index = f'{self.es_index}-{now:%Y-%m}'
-        else:
-            index = self.es_index
-        self.es.index(index=index, doc_type=self.es_index, body=str(response))
+            self._index = f'{self.es_index}-{now:%Y-%m}'
+            if now.month == 12:
+                next_month = datetime(now.year + 1, 1, 1)
+            else:
+                next_month = datetime(now.year, now.month + 1, 1)
+            self._index_expires = next_month.timestamp()
+        return self._index
+
+    def _bulk_body(self, docs: List[Tuple[str, str, int, int]]) -> str:
+        """
+        Build a newline delimited _bulk request from already serialized documents
+
+        """
+        lines = []
+        for index, doc, _, _ in docs:
+            action = {'index': {'_index': index, '_type': self.es_index}}
+            lines.append(json.dumps(action))
+            lines.append(doc)
+        return '\n'.join(lines) + '\n'
+
+    async def _flush(self) -> None:
+        """
+        Send all buffered documents in one _bulk request, requeueing documents
+        that failed with a retryable status
+
+        """
+        if not self._buffer:
+            return
+        docs, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        # Kept until the request completes, so a batch that is in flight when
+        # the plugin shuts down is sent again
+        self._in_flight[id(docs)] = docs
+        try:
+            result = await self.es.bulk(body=self._bulk_body(docs))
+        except TransportError as err:
+            del self._in_flight[id(docs)]
+            self.log.warning(f'Bulk request of {len(docs)} documents failed: {err}')
+            self._requeue(docs)
+            return
+        del self._in_flight[id(docs)]
+        if not result.get('errors'):
+            return
+        failed = []
+        for doc, item in zip(docs, result['items']):
+            status = item['index'].get('status', 0)
+            if status < 300:
+                continue
+            if status in RETRY_STATUSES:
+                failed.append(doc)
+            else:
+                self.log.error(
+                    f'Unable to index document into {doc[0]}: {item["index"].get("error")}'
+                )
+        self._requeue(failed)
+
+    def _requeue(self, docs: List[Tuple[str, str, int, int]]) -> None:
+        for index, doc, size, attempts in docs:
+            if attempts >= self.bulk_max_retries:
+                self.log.error(
+                    f'Dropping document for {index} after {attempts + 1} attempts'
+                )
+                continue
+            self._buffer.append((index, doc, size, attempts + 1))
+            self._buffer_bytes += size
+
+    def _restore_in_flight(self) -> None:
+        """
+        Buffer the batches of requests that never completed again, ahead of
+        anything buffered since
+
+        """
+        in_flight = [doc for docs in self._in_flight.values() for doc in docs]
+        self._in_flight.clear()
+        self._buffer[:0] = in_flight
+        self._buffer_bytes += sum(size for _, _, size, _ in in_flight)
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.bulk_interval)
+            try:
+                await self._flush()
+            except Exception as err:
+                self.log.error(f'Unable to flush buffered documents: {err}')
+
+    async def _close_on_shutdown(self) -> None:
+        """
+        Wait until this task is cancelled, either by `asyncio.run` at
+        shutdown or by `_flush_on_exit`, then flush everything that is
+        buffered or was in flight and close the client
+
+        """
+        try:
+            await asyncio.Event().wait()
+        finally:
+            if self._flusher is not None:
+                self._flusher.cancel()
+                await asyncio.gather(self._flusher, return_exceptions=True)
+            self._restore_in_flight()
+            try:
+                await self._flush()
+            except Exception as err:
+                self.log.error(f'Unable to flush buffered documents: {err}')
+            self._restore_in_flight()
+            await self.es.close()
+
+    def _flush_on_exit(self) -> None:
+        """
+        Close the client on the event loop it was bound to if it is still
+        open, as when stoq was run with `run_until_complete`. Anything left
+        after that, because the loop is closed or the final flush failed, is
+        sent with a synchronous client.
+
+        """
+        closer = self._closer
+        if closer is not None and not closer.done():
+            if not (self._loop.is_closed() or self._loop.is_running()):
+                closer.cancel()
+                self._loop.run_until_complete(
+                    asyncio.gather(closer, return_exceptions=True)
+                )
+        self._restore_in_flight()
+        if not self._buffer:
+            return
+        es = Elasticsearch(
+            self.es_host,
+            timeout=self.es_timeout,
+            max_retries=self.es_max_retries,
+            retry_on_timeout=self.es_retry,
+            ca_certs=certifi.where(),
+            **self.es_options,
+        )
+        try:
+            es.bulk(body=self._bulk_body(self._buffer))
+        except TransportError as err:
+            self.log.error(f'Unable to flush {len(self._buffer)} documents: {err}')
+        finally:
+            es.close()
+        self._buffer, self._buffer_bytes = [], 0
 
     def _connect(self):
         """
@@ -66,7 +241,7 @@ class ElasticSearchPlugin(ConnectorPlugin):
 
         """
         if not self.es:
-            self.es = Elasticsearch(
+            self.es = AsyncElasticsearch(
                 self.es_host,
                 timeout=self.es_timeout,
                 max_retries=self.es_max_retries,
@@ -74,3 +249,5 @@ class ElasticSearchPlugin(ConnectorPlugin):
                 ca_certs=certifi.where(),
                 **self.es_options,
             )
+            self._loop = asyncio.get_event_loop()
+            self._closer = asyncio.ensure_future(self._close_on_shutdown())
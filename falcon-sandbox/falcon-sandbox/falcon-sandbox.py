@@ -21,17 +21,21 @@ Scan payloads using Falcon Sandbox
 
 """
 
-import requests
-from time import sleep
+import asyncio
+import aiohttp
 from json import JSONDecodeError
-from configparser import ConfigParser
 from typing import Dict, Optional, Union, Tuple, List
 
 from stoq.plugins import WorkerPlugin
-from stoq.helpers import StoqConfigParser, get_sha1
+from stoq.helpers import StoqConfigParser, get_sha1, get_sha256
 from stoq.exceptions import StoqPluginException
 from stoq import Error, Payload, Request, WorkerResponse
 
+# Maximum number of reports requested at once from /report/summary
+SUMMARY_BATCH_SIZE = 100
+
+PENDING_STATES = ('IN_QUEUE', 'IN_PROGRESS')
+
 
 class FalconSandboxPlugin(WorkerPlugin):
     def __init__(self, config: StoqConfigParser) -> None:
@@ -56,6 +60,15 @@ class FalconSandboxPlugin(WorkerPlugin):
         self.wait_for_results = config.getboolean(
             'options', 'wait_for_results', fallback=True
         )
+        self.hash_lookup = config.getboolean('options', 'hash_lookup', fallback=True)
+        self.max_connections = config.getint(
+            'options', 'max_connections', fallback=10
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Outstanding job_ids, with the future of the scan waiting on each
+        # and the number of times it has been checked
+        self._jobs: Dict[str, Tuple[asyncio.Future, int]] = {}
+        self._poller: Optional[asyncio.Future] = None
 
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
         """
@@ -64,57 +77,134 @@ class FalconSandboxPlugin(WorkerPlugin):
         """
 
         errors: List[Error] = []
+        self._connect()
+        if self.hash_lookup:
+            results = await self._lookup_report(get_sha256(payload.content))
+            if results:
+                return WorkerResponse(results)
         url = f'{self.sandbox_url}/submit/file'
-        headers = {'api-key': self.apikey, 'user-agent': self.useragent}
         filename = payload.results.payload_meta.extra_data.get(
             'filename', get_sha1(payload.content)
         )
         if isinstance(filename, bytes):
             filename = filename.decode()
-        files = {'file': (filename, payload.content)}
-        data = {'environment_id': self.environment_id}
-        response = requests.post(url, data=data, files=files, headers=headers)
-        response.raise_for_status()
-        results = response.json()
+        data = aiohttp.FormData()
+        data.add_field('environment_id', str(self.environment_id))
+        data.add_field('file', payload.content, filename=filename)
+        async with self._session.post(url, data=data) as response:
+            response.raise_for_status()
+            results = await response.json()
         if self.wait_for_results:
-            results, errors = self._parse_results(results['job_id'])
+            results, error = await self._parse_results(results['job_id'])
+            if error:
+                errors.append(
+                    Error(
+                        error=error,
+                        plugin_name=self.plugin_name,
+                        payload_id=payload.results.payload_id,
+                    )
+                )
         return WorkerResponse(results, errors=errors)
 
-    def _parse_results(
+    async def _lookup_report(self, sha256: str) -> Optional[Dict]:
+        """
+        Retrieve an existing, completed report of the payload in the configured
+        environment
+
+        """
+        url = f'{self.sandbox_url}/report/{sha256}:{self.environment_id}/summary'
+        try:
+            async with self._session.get(url) as response:
+                if response.status == 404:
+                    return None
+                response.raise_for_status()
+                result = await response.json()
+        except (aiohttp.ClientError, JSONDecodeError) as err:
+            self.log.debug(f'Unable to look up report for {sha256}: {err}')
+            return None
+        if isinstance(result, dict) and result.get('state') not in PENDING_STATES:
+            return result
+        return None
+
+    async def _parse_results(
         self, job_id: str
-    ) -> Tuple[Union[Dict, None], Union[List[str], None]]:
+    ) -> Tuple[Union[Dict, None], Union[str, None]]:
         """
-        Wait for a scan to complete and then parse the results
+        Wait for the background poller to retrieve the completed report
 
         """
-        count = 0
-        errors: List[Error] = []
+        future = asyncio.get_event_loop().create_future()
+        self._jobs[job_id] = (future, 0)
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll())
+        try:
+            return await future
+        finally:
+            self._jobs.pop(job_id, None)
+
+    async def _poll(self) -> None:
+        """
+        Check all outstanding jobs every `delay` seconds, requesting their
+        summaries in batches
 
-        while count < self.max_attempts:
-            sleep(self.delay)
-            try:
-                url = f'{self.sandbox_url}/report/{job_id}/summary'
-                headers = {'api-key': self.apikey, 'user-agent': self.useragent}
-                response = requests.get(url, headers=headers)
+        """
+        while self._jobs:
+            await asyncio.sleep(self.delay)
+            job_ids = [j for j, (future, _) in self._jobs.items() if not future.done()]
+            batches = [
+                job_ids[i : i + SUMMARY_BATCH_SIZE]
+                for i in range(0, len(job_ids), SUMMARY_BATCH_SIZE)
+            ]
+            summaries: Dict[str, Dict] = {}
+            responses = await asyncio.gather(
+                *[self._summaries(b) for b in batches], return_exceptions=True
+            )
+            for batch, response in zip(batches, responses):
+                if isinstance(response, Exception):
+                    # Fail only the jobs in this batch, the poller keeps
+                    # running for all others
+                    for job_id in batch:
+                        future, _ = self._jobs.get(job_id, (None, 0))
+                        if future is not None and not future.done():
+                            future.set_exception(response)
+                else:
+                    summaries.update(response)
+            for job_id in job_ids:
+                if job_id not in self._jobs:
+                    continue
+                future, attempts = self._jobs[job_id]
+                if future.done():
+                    continue
+                summary = summaries.get(job_id)
+                if summary and summary.get('state') not in PENDING_STATES:
+                    future.set_result((summary, None))
+                elif attempts + 1 >= self.max_attempts:
+                    msg = f'Scan did not complete in time -- attempts: {attempts + 1}'
+                    future.set_result((None, msg))
+                else:
+                    self._jobs[job_id] = (future, attempts + 1)
+
+    async def _summaries(self, job_ids: List[str]) -> Dict[str, Dict]:
+        url = f'{self.sandbox_url}/report/summary'
+        data = [('hashes[]', job_id) for job_id in job_ids]
+        try:
+            async with self._session.post(url, data=data) as response:
                 response.raise_for_status()
-                result = response.json()
-                if result['state'] not in ('IN_QUEUE', 'IN_PROGRESS'):
-                    return result, errors
-            except (JSONDecodeError, KeyError) as err:
-                errors.append(
-                    Error(
-                        error=err, plugin_name=self.plugin_name, payload_id=payload_id
-                    )
-                )
-            finally:
-                count += 1
-                if count >= self.max_attempts:
-                    msg = f'Scan did not complete in time -- attempts: {count}'
-                    errors.append(
-                        Error(
-                            error=msg,
-                            plugin_name=self.plugin_name,
-                            payload_id=payload_id,
-                        )
-                    )
-        return None, errors
+                results = await response.json()
+            return {r['job_id']: r for r in results if 'job_id' in r}
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            JSONDecodeError,
+            KeyError,
+            TypeError,
+        ) as err:
+            self.log.debug(f'Unable to retrieve {len(job_ids)} reports: {err}')
+            return {}
+
+    def _connect(self) -> None:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                headers={'api-key': self.apikey, 'user-agent': self.useragent},
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+            )
@@ -21,11 +21,19 @@ Handle file and directory interactions
 """
 
 import os
+import time
+import atexit
+import asyncio
 import hashlib
+import threading
+import concurrent.futures
 
+from collections import deque
 from pathlib import Path
 from asyncio import Queue
 from datetime import datetime
+from typing import Any, Callable, Deque, IO, Optional, Set
+from concurrent.futures import ThreadPoolExecutor
 
 from stoq import helpers
 from stoq.helpers import StoqConfigParser
@@ -50,6 +58,41 @@ class FileDirPlugin(ProviderPlugin, ConnectorPlugin, ArchiverPlugin):
             'options', 'archive_dir', fallback=os.path.join(os.getcwd(), 'archive')
         )
         self.use_sha = config.getboolean('options', 'use_sha', fallback=True)
+        self.results_mode = config.get('options', 'results_mode', fallback='file')
+        if self.results_mode not in ('file', 'segment'):
+            raise StoqPluginException(
+                f'Unsupported results_mode {self.results_mode}, use file or segment'
+            )
+        self.segment_size = config.getint(
+            'options', 'segment_size', fallback=134217728
+        )
+        self.segment_age = config.getint('options', 'segment_age', fallback=3600)
+        self.compression = config.get('options', 'compression', fallback=None)
+        if self.compression and self.compression != 'zstd':
+            raise StoqPluginException(
+                f'Unsupported compression {self.compression}, use zstd'
+            )
+        self.fsync_interval = config.getint('options', 'fsync_interval', fallback=5)
+        self.max_in_flight = config.getint('options', 'max_in_flight', fallback=100)
+        self.read_workers = config.getint('options', 'read_workers', fallback=4)
+        self.checkpoint = config.get('options', 'checkpoint', fallback=None)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._checkpoint_file: Optional[IO] = None
+        self._checkpoint_pending = 0
+        # Paths placed on the stoQ queue, in order, that are not checkpointed
+        self._queued: Deque[str] = deque()
+        # Result directories that already exist
+        self._results_dirs: Set[Path] = set()
+        # The open result segment, the compressed stream written to it, the
+        # directory it is in and when it was opened and last synced
+        self._segment: Optional[IO] = None
+        self._segment_writer: Any = None
+        self._segment_dir: Optional[Path] = None
+        self._segment_opened = 0.0
+        self._segment_synced = 0.0
+        self._segment_count = 0
+        if self.results_mode == 'segment':
+            atexit.register(self._close_segment)
 
     async def ingest(self, queue: Queue) -> None:
         """
@@ -59,32 +102,150 @@ class FileDirPlugin(ProviderPlugin, ConnectorPlugin, ArchiverPlugin):
         if not self.source_dir:
             raise StoqPluginException('Source directory not defined')
         source_path = Path(self.source_dir).resolve()
-        if source_path.is_dir():
-            if self.recursive:
-                for path in source_path.rglob('**/*'):
-                    await self._queue(path, queue)
-            else:
-                for path in source_path.glob('*'):
-                    await self._queue(path, queue)
-        else:
-            await self._queue(source_path, queue)
+        processed = self._load_checkpoint()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.read_workers)
+
+        loop = asyncio.get_event_loop()
+        paths: Queue = Queue(self.max_in_flight)
+        stopped = threading.Event()
+
+        def put(path: str) -> bool:
+            # Wait for room in the paths queue, giving up if ingest has stopped
+            future = asyncio.run_coroutine_threadsafe(paths.put(path), loop)
+            while True:
+                try:
+                    future.result(timeout=1)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if stopped.is_set():
+                        future.cancel()
+                        return False
+
+        readers = [
+            asyncio.ensure_future(self._queue(paths, queue))
+            for _ in range(self.max_in_flight)
+        ]
+        try:
+            await loop.run_in_executor(
+                None, self._walk, str(source_path), processed, put, stopped
+            )
+            for _ in readers:
+                await paths.put(None)
+            await asyncio.gather(*readers)
+            # Files still on the queue are checkpointed once stoQ takes them
+            while self._checkpoint_queued(queue):
+                await asyncio.sleep(0.1)
+        finally:
+            stopped.set()
+            for reader in readers:
+                reader.cancel()
+            self._checkpoint_queued(queue)
+            self._close_checkpoint()
 
-    async def _queue(self, path: Path, queue: Queue) -> None:
+    def _walk(
+        self,
+        source: str,
+        processed: Set[str],
+        put: Callable[[str], bool],
+        stopped: threading.Event,
+    ) -> None:
         """
-        Publish payload to stoQ queue
+        Walk the source directory in a background thread, passing each file
+        that has not been processed yet to `put`
 
         """
-        if path.is_file() and not path.name.startswith('.'):
+        if not os.path.isdir(source):
+            if not os.path.isfile(source):
+                self.log.debug(f'Skipping {source}, does not exist or is invalid')
+            elif source not in processed:
+                put(source)
+            return
+        directories = [source]
+        while directories and not stopped.is_set():
+            try:
+                with os.scandir(directories.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.recursive:
+                                directories.append(entry.path)
+                        elif not entry.is_file() or entry.name.startswith('.'):
+                            self.log.debug(
+                                f'Skipping {entry.path}, does not exist or is invalid'
+                            )
+                        elif entry.path not in processed and not put(entry.path):
+                            return
+            except OSError as err:
+                self.log.warning(f'Unable to read directory: {err}')
+
+    async def _queue(self, paths: Queue, queue: Queue) -> None:
+        """
+        Read files in the thread pool and publish payloads to stoQ queue
+
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            path = await paths.get()
+            if path is None:
+                return
+            try:
+                content = await loop.run_in_executor(self._executor, self._read, path)
+            except OSError as err:
+                self.log.warning(f'Unable to read {path}: {err}')
+                continue
             meta = PayloadMeta(
                 extra_data={
-                    'filename': str(path.name),
-                    'source_dir': str(path.parent),
+                    'filename': os.path.basename(path),
+                    'source_dir': os.path.dirname(path),
                 }
             )
-            with open(path, "rb") as f:
-                await queue.put(Payload(f.read(), meta))
-        else:
-            self.log.debug(f'Skipping {path}, does not exist or is invalid')
+            await queue.put(Payload(content, meta))
+            self._queued.append(path)
+            self._checkpoint_queued(queue)
+
+    def _read(self, path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _load_checkpoint(self) -> Set[str]:
+        processed: Set[str] = set()
+        if not self.checkpoint:
+            return processed
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                processed.update(line.rstrip('\n') for line in f)
+        self._checkpoint_file = open(self.checkpoint, 'a')
+        return processed
+
+    def _checkpoint_queued(self, queue: Queue) -> int:
+        """
+        Checkpoint the files that stoQ has taken from the queue and return the
+        number still on it. Payloads leave the queue in order, and it may hold
+        payloads of other providers, so at least the oldest `len - qsize` of
+        this plugin's paths have left it.
+
+        """
+        if self._checkpoint_file is None:
+            self._queued.clear()
+            return 0
+        for _ in range(len(self._queued) - queue.qsize()):
+            self._save_checkpoint(self._queued.popleft())
+        return len(self._queued)
+
+    def _save_checkpoint(self, path: str) -> None:
+        if self._checkpoint_file is None:
+            return
+        self._checkpoint_file.write(f'{path}\n')
+        self._checkpoint_pending += 1
+        if self._checkpoint_pending >= self.max_in_flight:
+            self._checkpoint_file.flush()
+            self._checkpoint_pending = 0
+
+    def _close_checkpoint(self) -> None:
+        if self._checkpoint_file is not None:
+            self._checkpoint_file.close()
+            self._checkpoint_file = None
+            self._checkpoint_pending = 0
 
     async def save(self, response: StoqResponse) -> None:
         """
@@ -96,11 +257,76 @@ class FileDirPlugin(ProviderPlugin, ConnectorPlugin, ArchiverPlugin):
         if self.date_mode:
             now = datetime.now().strftime(self.date_format)
             path = path.joinpath(now)
-        path.mkdir(parents=True, exist_ok=True)
+        if path not in self._results_dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self._results_dirs.add(path)
+
+        result = f'{helpers.dumps(response, compactly=self.compactly)}\n'
+        if self.results_mode == 'segment':
+            self._write_segment(path, result.encode())
+            return
 
         filename = response.scan_id
         with open(path.joinpath(filename), 'x') as outfile:
-            outfile.write(f'{helpers.dumps(response, compactly=self.compactly)}\n')
+            outfile.write(result)
+
+    def _write_segment(self, path: Path, result: bytes) -> None:
+        """
+        Append a result to the open segment, rotating it once it reaches
+        `segment_size` bytes or `segment_age` seconds, or the date bucket
+        changes
+
+        """
+        now = time.monotonic()
+        if self._segment is not None and (
+            path != self._segment_dir
+            or (self.segment_size and self._segment.tell() >= self.segment_size)
+            or (self.segment_age and now - self._segment_opened >= self.segment_age)
+        ):
+            self._close_segment()
+        if self._segment is None:
+            self._open_segment(path)
+        self._segment_writer.write(result)
+        if self.fsync_interval and now - self._segment_synced >= self.fsync_interval:
+            self._segment_writer.flush()
+            if self._segment_writer is not self._segment:
+                self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._segment_synced = now
+
+    def _open_segment(self, path: Path) -> None:
+        self._segment_count += 1
+        filename = (
+            f'{datetime.now().strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-'
+            f'{self._segment_count:06d}.ndjson'
+        )
+        if self.compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise StoqPluginException(
+                    'zstd compression requires the zstandard package'
+                )
+            self._segment = open(path.joinpath(f'{filename}.zst'), 'xb')
+            self._segment_writer = zstandard.ZstdCompressor().stream_writer(
+                self._segment, closefd=False
+            )
+        else:
+            self._segment = open(path.joinpath(filename), 'xb')
+            self._segment_writer = self._segment
+        self._segment_dir = path
+        self._segment_opened = self._segment_synced = time.monotonic()
+
+    def _close_segment(self) -> None:
+        if self._segment is None:
+            return
+        if self._segment_writer is not self._segment:
+            self._segment_writer.close()
+        self._segment.flush()
+        if self.fsync_interval:
+            os.fsync(self._segment.fileno())
+        self._segment.close()
+        self._segment = self._segment_writer = self._segment_dir = None
 
     async def archive(self, payload: Payload, request: Request) -> ArchiverResponse:
         """
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+#   Copyright 2014-present PUNCH Cyber Analytics Group
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Measure gcs plugin archive and retrieval throughput against a local
+GCS emulator, such as fake-gcs-server:
+
+    $ docker run -d -p 4443:4443 fsouza/fake-gcs-server -scheme http
+    $ STORAGE_EMULATOR_HOST=http://localhost:4443 python benchmark.py
+
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import importlib.util
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud.storage import Client
+
+from stoq.helpers import StoqConfigParser
+from stoq.data_classes import Payload, Request
+
+
+def load_plugin(opts: dict):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gcs', 'gcs.py')
+    spec = importlib.util.spec_from_file_location('gcs', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    config = StoqConfigParser()
+    config.read_dict({'options': opts})
+    return module.GCSPlugin(config)
+
+
+async def run(args: argparse.Namespace) -> None:
+    plugin = load_plugin(
+        {
+            'project_id': 'stoq-benchmark',
+            'archive_bucket': args.bucket,
+            'max_workers': str(args.workers),
+            'chunk_size': str(args.chunk_size),
+            'composite_threshold': str(args.composite_threshold),
+        }
+    )
+    plugin._client = Client(project='stoq-benchmark', credentials=AnonymousCredentials())
+    bucket = plugin._client.bucket(args.bucket)
+    if not bucket.exists():
+        bucket.create()
+
+    payloads = [Payload(os.urandom(args.size)) for _ in range(args.count)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def archive(payload):
+        async with semaphore:
+            return await plugin.archive(payload, Request())
+
+    async def get(response):
+        async with semaphore:
+            return await plugin.get(response)
+
+    start = time.perf_counter()
+    responses = await asyncio.gather(*[archive(p) for p in payloads])
+    report('archive', args, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[get(r) for r in responses])
+    report('get', args, time.perf_counter() - start)
+
+
+def report(action: str, args: argparse.Namespace, elapsed: float) -> None:
+    total = args.size * args.count
+    print(
+        f'{action}: {args.count} x {args.size} bytes in {elapsed:.2f}s, '
+        f'{total / elapsed / 1048576:.1f} MiB/s'
+    )
+
+
+def main() -> None:
+    if not os.environ.get('STORAGE_EMULATOR_HOST'):
+        sys.exit('STORAGE_EMULATOR_HOST must be set to the emulator address')
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--bucket', default='stoq-benchmark')
+    parser.add_argument('--size', type=int, default=1048576)
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=16777216)
+    parser.add_argument('--composite-threshold', type=int, default=104857600)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,20 +20,27 @@ Read and write data to Google Cloud Storage
 
 """
 
+import io
+import os
+import time
 import base64
+import asyncio
 import hashlib
 import googleapiclient.discovery
 
-from io import BytesIO
-from time import sleep
-from random import randrange
+from uuid import uuid4
+from random import uniform
 from datetime import datetime
-from configparser import ConfigParser
-from typing import Optional, Dict
+from functools import partial
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import SSLError
-from google.cloud.storage import Blob, Client
+from google.cloud.storage import Blob, Bucket, Client
 from google.resumable_media.common import InvalidResponse
 from google.api_core.exceptions import GoogleAPICallError, InternalServerError
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 from stoq import StoqPluginException
 from stoq.helpers import StoqConfigParser
@@ -46,6 +53,80 @@ from stoq.data_classes import (
     PayloadMeta,
 )
 
+T = TypeVar('T')
+
+RETRY_EXCEPTIONS = (InvalidResponse, GoogleAPICallError, InternalServerError, SSLError)
+
+# GCS allows at most 32 source objects per compose request
+MAX_COMPOSE_PARTS = 32
+
+# Objects are encrypted with a 256 bit data key as nonce | ciphertext | tag
+ENCRYPTION_ALGORITHM = 'AES256-GCM'
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+# Resumable upload chunks must be a multiple of 256 KiB
+UPLOAD_CHUNK = 262144
+
+
+class _SealedReader(io.RawIOBase):
+    """
+    Read-only stream of a payload encrypted as it is read, as
+    nonce | ciphertext | tag
+
+    Only the output of the last read is kept, so the stream can only be
+    rewound within it, as resumable uploads do when recovering a chunk.
+
+    """
+
+    def __init__(self, key: bytes, plaintext: bytes) -> None:
+        super().__init__()
+        nonce = os.urandom(NONCE_SIZE)
+        self._encryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).encryptor()
+        self._plaintext = memoryview(plaintext)
+        self._offset = 0
+        # Encrypted bytes from the start of the last read onwards
+        self._buffer = nonce
+        self._buffer_start = 0
+        self._position = 0
+        self.size = NONCE_SIZE + len(plaintext) + TAG_SIZE
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if not self._buffer_start <= offset <= self._buffer_start + len(self._buffer):
+            raise io.UnsupportedOperation('Unable to seek outside the last read')
+        self._position = offset
+        return offset
+
+    def read(self, size: int = -1) -> bytes:
+        start = self._position
+        end = self.size if size is None or size < 0 else min(start + size, self.size)
+        self._buffer = self._buffer[start - self._buffer_start :]
+        self._buffer_start = start
+        while start + len(self._buffer) < end:
+            if self._offset < len(self._plaintext):
+                stop = self._offset + end - start - len(self._buffer)
+                chunk = self._encryptor.update(self._plaintext[self._offset : stop])
+                self._offset = stop
+            else:
+                chunk = self._encryptor.finalize() + self._encryptor.tag
+            self._buffer += chunk
+        data = self._buffer[: end - start]
+        self._position = end
+        return data
+
 
 class GCSPlugin(ArchiverPlugin, ConnectorPlugin):
     def __init__(self, config: StoqConfigParser) -> None:
@@ -59,6 +140,11 @@ class GCSPlugin(ArchiverPlugin, ConnectorPlugin):
         self.use_sha = config.getboolean('options', 'use_sha', fallback=True)
         self.use_datetime = config.getboolean('options', 'use_datetime', fallback=False)
         self.max_retries = config.getint('options', 'max_retries', fallback=5)
+        self.max_workers = config.getint('options', 'max_workers', fallback=8)
+        self.chunk_size = config.getint('options', 'chunk_size', fallback=16777216)
+        self.composite_threshold = config.getint(
+            'options', 'composite_threshold', fallback=104857600
+        )
         self.use_encryption = config.getboolean(
             'options', 'use_encryption', fallback=False
         )
@@ -72,13 +158,27 @@ class GCSPlugin(ArchiverPlugin, ConnectorPlugin):
                 'cloudkms', 'v1', cache_discovery=False
             )
             self.kms_key = f'projects/{self.project_id}/locations/{self.location_id}/keyRings/{self.keyring_id}/cryptoKeys/{self.crypto_id}'
+        self.data_key_ttl = config.getint('options', 'data_key_ttl', fallback=3600)
+        self._data_key: Optional[Tuple[bytes, str, float]] = None
+        # Created on first use, so it is bound to the event loop the plugin runs in
+        self._data_key_lock: Optional[asyncio.Lock] = None
+        self._data_keys: 'OrderedDict[str, bytes]' = OrderedDict()
+        # Data keys being unwrapped, shared by every get waiting on them
+        self._unwrapping: Dict[str, asyncio.Future] = {}
+        self._client: Optional[Client] = None
+        self._buckets: Dict[str, Bucket] = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        # The KMS client is not thread safe, so KMS calls run in a single thread
+        self._kms_executor = ThreadPoolExecutor(max_workers=1)
 
     async def save(self, response: StoqResponse) -> None:
         """
         Save results to Google Cloud Storage
 
         """
-        self._upload(str(response).encode(), response.scan_id, self.connector_bucket)
+        await self._upload(
+            str(response).encode(), response.scan_id, self.connector_bucket
+        )
 
     async def archive(self, payload: Payload, request: Request) -> ArchiverResponse:
         """
@@ -94,7 +194,7 @@ class GCSPlugin(ArchiverPlugin, ConnectorPlugin):
             filename = f'{datetime_path}/{payload.payload_id}'
         else:
             filename = payload.results.payload_id
-        self._upload(payload.content, filename, self.archive_bucket)
+        await self._upload(payload.content, filename, self.archive_bucket)
         return ArchiverResponse(
             {
                 'bucketId': self.archive_bucket,
@@ -115,64 +215,221 @@ class GCSPlugin(ArchiverPlugin, ConnectorPlugin):
                 'projectId': task.results['projectId'],
             }
         )
-        count = 0
-        client = Client(project=task.results['projectId'])
-        while count < self.max_retries:
-            try:
-                bucket = client.get_bucket(task.results['bucketId'])
-                blob = Blob(task.results['objectId'], bucket)
-                content = BytesIO()
-                blob.download_to_file(content)
-                break
-            except (
-                InvalidResponse,
-                GoogleAPICallError,
-                InternalServerError,
-                SSLError,
-            ) as e:
-                if count >= self.max_retries:
-                    raise StoqPluginException(
-                        f'Failed to download {task.results["bucketId"]}/{task.results["objectId"]} from GCS: {str(e)}'
+        bucket = self._bucket(task.results['bucketId'])
+        error = (
+            f'Failed to download {task.results["bucketId"]}/'
+            f'{task.results["objectId"]} from GCS'
+        )
+        blob = await self._retry(
+            partial(bucket.get_blob, task.results['objectId']), error
+        )
+        if blob is None:
+            raise StoqPluginException(f'{error}: Not Found')
+        if blob.size <= self.chunk_size:
+            data = await self._retry(blob.download_as_bytes, error)
+        else:
+            # Download large objects in ranges, in parallel, all from the
+            # generation whose size was fetched in case the object is replaced
+            pinned = Blob(blob.name, bucket, generation=blob.generation)
+            chunks = await asyncio.gather(
+                *[
+                    self._retry(
+                        partial(
+                            pinned.download_as_bytes,
+                            start=start,
+                            end=min(start + self.chunk_size, blob.size) - 1,
+                        ),
+                        error,
                     )
-                count += 1
-                sleep(randrange(0, 4))
-        content.seek(0)
-        data = content.read()
+                    for start in range(0, blob.size, self.chunk_size)
+                ]
+            )
+            data = b''.join(chunks)
         if self.use_encryption:
-            data = self._decrypt(data)
+            data = await self._decrypt(data, blob.metadata or {})
         return Payload(data, meta)
 
-    def _upload(self, payload: bytes, filename: str, bucket: str) -> None:
+    async def _upload(self, payload: bytes, filename: str, bucket: str) -> None:
         """
         Upload a payload to GCS
 
+        Encrypted payloads are encrypted as they are uploaded, the ciphertext
+        is never held in memory as a whole
+
         """
+        bucket_obj = self._bucket(bucket)
+        blob = Blob(filename, bucket_obj)
+        error = f'Failed to upload {bucket}/{filename} to GCS'
+        key = None
+        size = len(payload)
+        if self.use_encryption:
+            key, blob.metadata = await self._encrypt()
+            size += NONCE_SIZE + TAG_SIZE
+        if size < self.composite_threshold:
+            if key is None:
+                await self._retry(partial(blob.upload_from_string, payload), error)
+            else:
+                # Resumable uploads read the ciphertext one chunk at a time
+                blob.chunk_size = max(1, self.chunk_size // UPLOAD_CHUNK) * UPLOAD_CHUNK
+                await self._retry(
+                    partial(self._upload_sealed, blob, key, payload), error
+                )
+            return
+
+        # Large payloads are uploaded in parallel as temporary objects that are
+        # then composed into the final object. Part names are unique to this
+        # upload so concurrent uploads of the same payload don't collide.
+        part_size = max(self.chunk_size, -(-size // MAX_COMPOSE_PARTS))
+        upload_id = uuid4().hex
+        reader = io.BytesIO(payload) if key is None else _SealedReader(key, payload)
+        # Only max_workers parts are read from the payload ahead of their upload
+        semaphore = asyncio.Semaphore(self.max_workers)
+        parts: List[Blob] = []
+        uploads = []
 
-        client = Client(project=self.project_id)
-        count = 0
-        while count < self.max_retries:
+        async def upload_part(part: Blob, data: bytes) -> None:
             try:
-                bucket_obj = client.get_bucket(bucket)
-                if self.use_encryption:
-                    payload = self._encrypt(payload)
-                content = BytesIO(payload)
-                blob = Blob(filename, bucket_obj)
-                blob.upload_from_file(content)
-                break
-            except (
-                InvalidResponse,
-                GoogleAPICallError,
-                InternalServerError,
-                SSLError,
-            ) as e:
-                if count >= self.max_retries:
-                    raise StoqPluginException(
-                        f'Failed to upload {bucket}/{filename} to GCS: {str(e)}'
-                    )
-                count += 1
-                sleep(randrange(0, 4))
+                await self._retry(partial(part.upload_from_string, data), error)
+            finally:
+                semaphore.release()
+
+        try:
+            for idx in range(-(-size // part_size)):
+                await semaphore.acquire()
+                data = await self._run(partial(reader.read, part_size))
+                part = Blob(f'{filename}.{upload_id}.part{idx}', bucket_obj)
+                parts.append(part)
+                uploads.append(asyncio.ensure_future(upload_part(part, data)))
+            await asyncio.gather(*uploads)
+            await self._retry(partial(blob.compose, parts), error)
+        finally:
+            for upload in uploads:
+                upload.cancel()
+            await asyncio.gather(*uploads, return_exceptions=True)
+            await self._run(
+                partial(bucket_obj.delete_blobs, parts, on_error=lambda blob: None)
+            )
+
+    def _upload_sealed(self, blob: Blob, key: bytes, payload: bytes) -> None:
+        # A new nonce for every attempt, as the stream can not be rewound
+        reader = _SealedReader(key, payload)
+        blob.upload_from_file(reader, size=reader.size)
+
+    async def _retry(self, func: Callable[[], T], error: str) -> T:
+        """
+        Run a blocking GCS call in the thread pool, retrying failures with
+        exponential backoff and full jitter
+
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._run(func)
+            except RETRY_EXCEPTIONS as e:
+                if attempt >= self.max_retries:
+                    raise StoqPluginException(f'{error}: {str(e)}')
+                await asyncio.sleep(uniform(0, min(32, 2 ** attempt)))
+
+    async def _run(self, func: Callable[[], T]) -> T:
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func)
+
+    async def _run_kms(self, func: Callable[[], T]) -> T:
+        return await asyncio.get_event_loop().run_in_executor(self._kms_executor, func)
+
+    def _bucket(self, name: str) -> Bucket:
+        """
+        Return a cached bucket handle, without fetching its metadata
+
+        """
+        if self._client is None:
+            self._client = Client(project=self.project_id)
+        if name not in self._buckets:
+            self._buckets[name] = self._client.bucket(name)
+        return self._buckets[name]
+
+    async def _encrypt(self) -> Tuple[bytes, Dict[str, str]]:
+        """
+        Return the data key to encrypt a payload with locally, and the object
+        metadata needed to decrypt it, which includes the key wrapped by KMS
+
+        """
+        key, wrapped_key = await self._get_data_key()
+        return (
+            key,
+            {'stoq-encryption': ENCRYPTION_ALGORITHM, 'stoq-wrapped-key': wrapped_key},
+        )
+
+    async def _decrypt(self, ciphertext: bytes, metadata: Dict[str, str]) -> bytes:
+        """
+        Decrypt a payload with its data key, unwrapping it with KMS if needed
+
+        """
+        wrapped_key = metadata.get('stoq-wrapped-key')
+        if not wrapped_key:
+            # Encrypted directly with KMS by earlier versions of this plugin
+            return await self._run_kms(partial(self._kms_decrypt, ciphertext))
+        key = self._data_keys.get(wrapped_key)
+        if key is not None:
+            self._data_keys.move_to_end(wrapped_key)
+        else:
+            future = self._unwrapping.get(wrapped_key)
+            if future is None:
+                future = asyncio.ensure_future(self._unwrap(wrapped_key))
+                self._unwrapping[wrapped_key] = future
+                future.add_done_callback(
+                    lambda _: self._unwrapping.pop(wrapped_key, None)
+                )
+            # Shielded so a cancelled get doesn't cancel others waiting on it
+            key = await asyncio.shield(future)
+        return await self._run(partial(self._open, key, ciphertext))
+
+    async def _unwrap(self, wrapped_key: str) -> bytes:
+        """
+        Unwrap a data key with KMS and cache it
+
+        """
+        key = await self._run_kms(
+            partial(self._kms_decrypt, base64.b64decode(wrapped_key))
+        )
+        self._data_keys[wrapped_key] = key
+        if len(self._data_keys) > 32:
+            self._data_keys.popitem(last=False)
+        return key
+
+    async def _get_data_key(self) -> Tuple[bytes, str]:
+        """
+        Return the current data key and its KMS wrapped form, generating a new
+        one once data_key_ttl has passed
+
+        """
+        if self._data_key_lock is None:
+            self._data_key_lock = asyncio.Lock()
+        async with self._data_key_lock:
+            now = time.monotonic()
+            if self._data_key is None or now - self._data_key[2] >= self.data_key_ttl:
+                key = os.urandom(32)
+                wrapped_key = await self._run_kms(partial(self._kms_encrypt, key))
+                self._data_key = (key, base64.b64encode(wrapped_key).decode(), now)
+            return self._data_key[0], self._data_key[1]
+
+    def _open(self, key: bytes, ciphertext: bytes) -> bytes:
+        if len(ciphertext) < NONCE_SIZE + TAG_SIZE:
+            raise StoqPluginException('Unable to decrypt payload: Invalid ciphertext')
+        view = memoryview(ciphertext)
+        nonce, tag = view[:NONCE_SIZE], view[-TAG_SIZE:]
+        decryptor = Cipher(
+            algorithms.AES(key), modes.GCM(bytes(nonce), bytes(tag))
+        ).decryptor()
+        view = view[NONCE_SIZE:-TAG_SIZE]
+        chunks = []
+        for start in range(0, len(view), self.chunk_size):
+            chunks.append(decryptor.update(view[start : start + self.chunk_size]))
+        try:
+            chunks.append(decryptor.finalize())
+        except InvalidTag:
+            raise StoqPluginException('Unable to decrypt payload: Invalid tag')
+        return b''.join(chunks)
 
-    def _decrypt(self, ciphertext: bytes) -> bytes:
+    def _kms_decrypt(self, ciphertext: bytes) -> bytes:
         """
         Decrypt an encrypted file with KMS
 
@@ -187,7 +444,7 @@ class GCSPlugin(ArchiverPlugin, ConnectorPlugin):
         response = request.execute()
         return base64.b64decode(response['plaintext'].encode('ascii'))
 
-    def _encrypt(self, plaintext: bytes) -> bytes:
+    def _kms_encrypt(self, plaintext: bytes) -> bytes:
         """
         Encrypts data from plaintext to ciphertext using KMS
 
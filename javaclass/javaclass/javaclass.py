@@ -24,21 +24,33 @@ from typing import Dict
 from javatools import unpack_class, ClassUnpackException
 
 from stoq.plugins import WorkerPlugin
+from stoq.helpers import StoqConfigParser
 from stoq.exceptions import StoqPluginException
 from stoq import Payload, Request, WorkerResponse
+from stoq_processpool import ProcessPool
 
 
 class JavaClassPlugin(WorkerPlugin):
+    def __init__(self, config: StoqConfigParser) -> None:
+        super().__init__(config)
+
+        self._process_pool = ProcessPool(self, config)
+
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
         """
         Decodes and extracts information from Java Class files
 
         """
 
+        if self._process_pool.enabled:
+            return await self._process_pool.run(payload.content)
+        return self._parse(payload.content)
+
+    def _parse(self, content: bytes) -> WorkerResponse:
         results: Dict = {}
 
         try:
-            content = unpack_class(payload.content)
+            content = unpack_class(content)
         except ClassUnpackException as err:
             raise StoqPluginException(f'Unable to parse payload: {err}')
 
@@ -15,7 +15,9 @@
 #   limitations under the License.
 
 import os
+import sys
 import logging
+import unittest
 import asynctest
 
 from pathlib import Path
@@ -53,3 +55,19 @@ class TestCore(asynctest.TestCase):
         payload = Payload(b'definitely not a javaclass payload')
         with self.assertRaises(StoqPluginException):
             response = await plugin.scan(payload, Request())
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'process pools require python 3.8+')
+    async def test_scan_process_pool(self) -> None:
+        s = Stoq(
+            plugin_dir_list=[self.plugin_dir],
+            plugin_opts={self.plugin_name: {'process_pool': True}},
+        )
+        plugin = s.load_plugin(self.plugin_name)
+        with open(f'{self.data_dir}/TestJavaClass.class', 'rb') as f:
+            payload = Payload(f.read())
+        response = await plugin.scan(payload, Request())
+        self.assertIsInstance(response, WorkerResponse)
+        self.assertIn('TestJavaClass', response.results['provided'])
+        payload = Payload(b'definitely not a javaclass payload')
+        with self.assertRaises(StoqPluginException):
+            response = await plugin.scan(payload, Request())
@@ -20,12 +20,21 @@ Publish and Consume messages from a Kafka Server
 """
 
 import json
-from kafka import KafkaProducer
-from collections import ChainMap
-from typing import Dict, Optional
-from base64 import b64encode, b64decode
+import time
+import atexit
+import asyncio
+from functools import partial
+from collections import ChainMap, defaultdict
+from base64 import b64decode
 from asyncio import Queue, get_event_loop
-from aiokafka import AIOKafkaConsumer
+from typing import Dict, List, Optional, Set, Tuple, Union
+from aiokafka import (
+    AIOKafkaConsumer,
+    AIOKafkaProducer,
+    ConsumerRecord,
+    TopicPartition,
+)
+from aiokafka.errors import KafkaError
 
 from stoq.helpers import StoqConfigParser, dumps
 from stoq.plugins import ArchiverPlugin, ConnectorPlugin, ProviderPlugin
@@ -43,20 +52,46 @@ class KafkaPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
     def __init__(self, config: StoqConfigParser) -> None:
         super().__init__(config)
         self.producer = None
+        self._producer_started: Optional[asyncio.Future] = None
+        self._producer_stopper: Optional[asyncio.Future] = None
+        self._producer_stopped = False
+        self._pending: Set[asyncio.Future] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
 
         self.servers = config.getlist('options', 'servers', fallback=['127.0.0.1:9092'])
         self.group = config.get('options', 'group', fallback='stoq')
         self.topic = config.get('options', 'topic', fallback="stoq")
+        self.retries = config.getint('options', 'retries', fallback=5)
         self.publish_archive = config.getboolean(
             'options', 'publish_archive', fallback=True
         )
-        self.retries = config.getint('options', 'retries', fallback=5)
+        self.linger_ms = config.getint('options', 'linger_ms', fallback=100)
+        self.max_batch_size = config.getint(
+            'options', 'max_batch_size', fallback=1048576
+        )
+        self.max_request_size = config.getint(
+            'options', 'max_request_size', fallback=1048576
+        )
+        self.compression_type = config.get('options', 'compression_type', fallback=None)
+        self.max_pending = config.getint('options', 'max_pending', fallback=10000)
         self.session_timeout_ms = config.getint(
             'options', 'session_timeout_ms', fallback=15000
         )
         self.heartbeat_interval_ms = config.getint(
             'options', 'heartbeat_interval_ms', fallback=5000
         )
+        self.fetch_max_records = config.getint(
+            'options', 'fetch_max_records', fallback=500
+        )
+        self.fetch_timeout_ms = config.getint(
+            'options', 'fetch_timeout_ms', fallback=1000
+        )
+        self.max_in_flight = config.getint('options', 'max_in_flight', fallback=1000)
+        self.lag_log_interval = config.getint(
+            'options', 'lag_log_interval', fallback=60
+        )
+        self.lag: Dict[str, int] = {}
+        self._lag_logged = 0.0
 
     async def archive(
         self, payload: Payload, request: Request
@@ -65,15 +100,14 @@ class KafkaPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
         Archive Payload object to Kafka queue
 
         """
-        self._connect()
-        msg = {
-            '_is_payload': True,
-            '_content': b64encode(payload.content),
-            '_payload_meta': payload.results.payload_meta.extra_data,
-            '_request_meta': request.request_meta,
-        }
-        self.producer.send(self.topic, dumps(msg).encode())
-        self.producer.flush()
+        await self._connect()
+        # The payload is sent as is, its metadata is carried in the headers
+        headers = [
+            ('_is_payload', b'1'),
+            ('_payload_meta', dumps(payload.results.payload_meta.extra_data).encode()),
+            ('_request_meta', dumps(request.request_meta).encode()),
+        ]
+        await self._send(payload.content, headers)
         return ArchiverResponse()
 
     async def save(self, response: StoqResponse) -> None:
@@ -87,7 +121,7 @@ class KafkaPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
         sent to the queue, not the payload itself.
 
         """
-        self._connect()
+        await self._connect()
         if self.publish_archive:
             for result in response.results:
                 for archiver, meta in result.archivers.items():
@@ -102,10 +136,9 @@ class KafkaPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
                             )
                         )
                     }
-                    self.producer.send(self.topic, dumps(r).encode())
+                    await self._send(dumps(r).encode())
         else:
-            self.producer.send(self.topic, str(response).encode())
-        self.producer.flush()
+            await self._send(str(response).encode())
 
     async def ingest(self, queue: Queue) -> None:
         consumer = AIOKafkaConsumer(
@@ -115,30 +148,255 @@ class KafkaPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
             bootstrap_servers=self.servers,
             heartbeat_interval_ms=self.heartbeat_interval_ms,
             session_timeout_ms=self.session_timeout_ms,
-            loop=get_event_loop(),
+            enable_auto_commit=False,
         )
         await consumer.start()
         self.log.info(f'Monitoring {self.topic} topic for messages...')
 
-        async for message in consumer:
-            msg = json.loads(message.value)
-            if msg.get('_is_payload'):
-                # This message is a payload that was placed on the queue
-                # from the kafka-queue archiver plugin
-                extra_data = msg['_payload_meta']
-                extra_data['request_meta'] = msg['_request_meta']
-                meta = PayloadMeta(extra_data=extra_data)
-                payload = Payload(content=b64decode(msg['_content']), payload_meta=meta)
-                await queue.put(payload)
-            else:
-                await queue.put(msg)
-
-    def _connect(self) -> None:
+        # Per partition: messages fetched but not yet accepted by the queue,
+        # the offset after the last fetched message, and the last batch handed
+        # off so offsets are committed in order. Partitions with a batch that
+        # failed to be queued are rewound to its first offset.
+        in_flight: Dict[TopicPartition, int] = defaultdict(int)
+        fetched: Dict[TopicPartition, int] = {}
+        tails: Dict[TopicPartition, asyncio.Future] = {}
+        rewind: Dict[TopicPartition, int] = {}
+        try:
+            while True:
+                # Rewound once every batch handed off before the failure is done
+                for tp in [tp for tp in rewind if tails[tp].done()]:
+                    offset = rewind.pop(tp)
+                    del tails[tp]
+                    if tp in consumer.assignment():
+                        consumer.seek(tp, offset)
+                        fetched[tp] = offset
+                batches = await consumer.getmany(
+                    timeout_ms=self.fetch_timeout_ms, max_records=self.fetch_max_records
+                )
+                for tp, messages in batches.items():
+                    if tp in rewind:
+                        # Fetched again once the partition is rewound
+                        continue
+                    fetched[tp] = messages[-1].offset + 1
+                    in_flight[tp] += len(messages)
+                    if in_flight[tp] >= self.max_in_flight:
+                        consumer.pause(tp)
+                    tails[tp] = asyncio.ensure_future(
+                        self._enqueue(
+                            consumer,
+                            queue,
+                            tp,
+                            messages,
+                            tails.get(tp),
+                            in_flight,
+                            rewind,
+                        )
+                    )
+                self._update_lag(consumer, fetched, in_flight)
+        finally:
+            # Uncommitted messages are redelivered when the consumer restarts
+            for tail in tails.values():
+                tail.cancel()
+            await asyncio.gather(*tails.values(), return_exceptions=True)
+            await consumer.stop()
+
+    async def _enqueue(
+        self,
+        consumer: AIOKafkaConsumer,
+        queue: Queue,
+        tp: TopicPartition,
+        messages: List[ConsumerRecord],
+        previous: Optional[asyncio.Future],
+        in_flight: Dict[TopicPartition, int],
+        rewind: Dict[TopicPartition, int],
+    ) -> None:
+        """
+        Decode a batch of messages off the event loop, place them on the
+        queue and commit their offsets once the queue has accepted them
+
+        """
+        offset = messages[0].offset
+        try:
+            decoded = await get_event_loop().run_in_executor(
+                None, self._decode_messages, messages
+            )
+            if previous is not None:
+                await asyncio.wait([previous])
+            if rewind.get(tp, offset) < offset:
+                # An earlier batch was never queued, committing this batch's
+                # offset would skip its messages
+                return
+            for item in decoded:
+                await queue.put(item)
+            try:
+                await consumer.commit({tp: messages[-1].offset + 1})
+            except KafkaError as err:
+                # Likely a rebalance, the messages will be redelivered
+                self.log.warning(f'Unable to commit offset for {tp}: {err}')
+        except Exception as err:
+            self.log.error(f'Unable to queue messages from {tp} at {offset}: {err}')
+            rewind[tp] = min(rewind.get(tp, offset), offset)
+        finally:
+            in_flight[tp] -= len(messages)
+            if in_flight[tp] < self.max_in_flight and tp in consumer.paused():
+                consumer.resume(tp)
+
+    def _decode_messages(
+        self, messages: List[ConsumerRecord]
+    ) -> List[Union[Payload, Dict]]:
+        decoded: List[Union[Payload, Dict]] = []
+        for message in messages:
+            try:
+                decoded.append(self._decode(message))
+            except (ValueError, KeyError, TypeError) as err:
+                self.log.error(
+                    f'Unable to decode message at {message.topic}-'
+                    f'{message.partition}:{message.offset}: {err}'
+                )
+        return decoded
+
+    def _decode(self, message: ConsumerRecord) -> Union[Payload, Dict]:
+        headers = dict(message.headers or ())
+        if headers.get('_is_payload'):
+            # Raw payload from the kafka-queue archiver plugin
+            extra_data = json.loads(headers['_payload_meta'])
+            extra_data['request_meta'] = json.loads(headers['_request_meta'])
+            meta = PayloadMeta(extra_data=extra_data)
+            return Payload(content=message.value, payload_meta=meta)
+        msg = json.loads(message.value)
+        if msg.get('_is_payload'):
+            # This message is a payload that was placed on the queue
+            # from the kafka-queue archiver plugin
+            extra_data = msg['_payload_meta']
+            extra_data['request_meta'] = msg['_request_meta']
+            meta = PayloadMeta(extra_data=extra_data)
+            return Payload(content=b64decode(msg['_content']), payload_meta=meta)
+        return msg
+
+    def _update_lag(
+        self,
+        consumer: AIOKafkaConsumer,
+        fetched: Dict[TopicPartition, int],
+        in_flight: Dict[TopicPartition, int],
+    ) -> None:
+        """
+        Record how many messages each assigned partition is behind
+
+        Messages that were fetched but not yet accepted by the queue are
+        counted as lag, as their offsets have not been committed.
+
+        """
+        lag: Dict[str, int] = {}
+        for tp in consumer.assignment():
+            highwater = consumer.highwater(tp)
+            if highwater is None or tp not in fetched:
+                continue
+            lag[f'{tp.topic}-{tp.partition}'] = highwater - fetched[tp] + in_flight[tp]
+        self.lag = lag
+        now = time.monotonic()
+        if self.lag_log_interval and now - self._lag_logged >= self.lag_log_interval:
+            self._lag_logged = now
+            self.log.info(f'Consumer lag for {self.topic}: {lag}')
+
+    async def _send(
+        self,
+        value: bytes,
+        headers: Optional[List[Tuple[str, bytes]]] = None,
+        attempt: int = 0,
+    ) -> None:
+        """
+        Queue a message on the producer without waiting for delivery
+
+        Messages are batched by the producer and only flushed here once
+        `max_pending` messages are awaiting delivery.
+
+        """
+        delivery = await self.producer.send(self.topic, value, headers=headers)
+        self._pending.add(delivery)
+        delivery.add_done_callback(partial(self._delivered, value, headers, attempt))
+        if len(self._pending) >= self.max_pending:
+            await self.producer.flush()
+
+    def _delivered(
+        self,
+        value: bytes,
+        headers: Optional[List[Tuple[str, bytes]]],
+        attempt: int,
+        delivery: asyncio.Future,
+    ) -> None:
+        """
+        Send a message again if its delivery failed with a retriable error,
+        up to `retries` times
+
+        """
+        self._pending.discard(delivery)
+        if delivery.cancelled() or not delivery.exception():
+            return
+        err = delivery.exception()
+        if attempt < self.retries and getattr(err, 'retriable', False):
+            retry = asyncio.ensure_future(self._send(value, headers, attempt + 1))
+            self._pending.add(retry)
+            retry.add_done_callback(self._pending.discard)
+            return
+        self.log.error(f'Failed to publish message: {err}')
+
+    async def _stop_producer(self) -> None:
+        """
+        Wait for every message awaiting delivery, including retries, then
+        flush anything still batched and stop the producer
+
+        """
+        if self._producer_stopped:
+            return
+        self._producer_stopped = True
+        while self._pending:
+            await asyncio.wait(list(self._pending))
+        await self.producer.stop()
+
+    async def _stop_on_shutdown(self) -> None:
+        """
+        Wait until this task is cancelled, either by `asyncio.run` at
+        shutdown or by `_stop_on_exit`, then stop the producer
+
+        """
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self._stop_producer()
+
+    def _stop_on_exit(self) -> None:
+        """
+        Stop the producer when the event loop was left open at exit, e.g.
+        when stoq was run with `run_until_complete`, which never cancels
+        `_stop_on_shutdown`
+
+        """
+        stopper = self._producer_stopper
+        if stopper is None or stopper.done():
+            return
+        if self._loop.is_closed() or self._loop.is_running():
+            self.log.error(
+                f'Unable to flush {len(self._pending)} messages awaiting delivery'
+            )
+            return
+        stopper.cancel()
+        self._loop.run_until_complete(asyncio.gather(stopper, return_exceptions=True))
+
+    async def _connect(self) -> None:
         """
         Connect to Kafka to publish a message
 
         """
         if not self.producer:
-            self.producer = KafkaProducer(
-                bootstrap_servers=self.servers, retries=self.retries
+            self.producer = AIOKafkaProducer(
+                bootstrap_servers=self.servers,
+                linger_ms=self.linger_ms,
+                max_batch_size=self.max_batch_size,
+                max_request_size=self.max_request_size,
+                compression_type=self.compression_type,
             )
+            self._loop = get_event_loop()
+            self._producer_started = asyncio.ensure_future(self.producer.start())
+            self._producer_stopper = asyncio.ensure_future(self._stop_on_shutdown())
+            atexit.register(self._stop_on_exit)
+        await self._producer_started
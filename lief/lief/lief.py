@@ -28,6 +28,7 @@ from stoq.helpers import StoqConfigParser
 from stoq.plugins import WorkerPlugin
 from stoq.exceptions import StoqPluginException
 from stoq import Payload, Request, WorkerResponse
+from stoq_processpool import ProcessPool
 
 
 class LiefPlugin(WorkerPlugin):
@@ -35,6 +36,7 @@ class LiefPlugin(WorkerPlugin):
         super().__init__(config)
 
         self.abstract = config.getboolean('options', 'abstract', fallback=True)
+        self._process_pool = ProcessPool(self, config)
 
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
         """
@@ -45,8 +47,13 @@ class LiefPlugin(WorkerPlugin):
             'filename', payload.results.payload_id
         )
 
+        if self._process_pool.enabled:
+            return await self._process_pool.run(payload.content, filename)
+        return self._parse(payload.content, filename)
+
+    def _parse(self, content: bytes, filename: str) -> WorkerResponse:
         try:
-            binary = lief.parse(raw=payload.content, name=filename)
+            binary = lief.parse(raw=content, name=filename)
         except lief.exception as err:
             raise StoqPluginException(f'Unable to parse payload: {err}')
 
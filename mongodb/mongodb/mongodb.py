@@ -21,17 +21,18 @@ Save results and archive payloads using MongoDB
 """
 
 import json
+import atexit
+import asyncio
 
-from gridfs import GridFS
 from pymongo import MongoClient
-from pymongo.errors import (
-    DuplicateKeyError,
-    ServerSelectionTimeoutError,
-    ConnectionFailure,
-    NetworkTimeout,
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from typing import Dict, List, Optional, Tuple
+from gridfs.errors import FileExists, NoFile
+from motor.motor_asyncio import (
+    AsyncIOMotorClient,
+    AsyncIOMotorGridFSBucket,
+    AsyncIOMotorGridIn,
 )
-from typing import Optional, Dict
-from gridfs.errors import FileExists
 
 from stoq.helpers import StoqConfigParser, get_sha1
 from stoq.plugins import ConnectorPlugin, ArchiverPlugin
@@ -43,6 +44,11 @@ from stoq.data_classes import (
     PayloadMeta,
 )
 
+DUPLICATE_KEY = 11000
+# Write error codes of transient server conditions, such as a primary stepping
+# down, that are worth retrying
+RETRY_CODES = {6, 7, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
 
 class MongoDbPlugin(ArchiverPlugin, ConnectorPlugin):
     def __init__(self, config: StoqConfigParser) -> None:
@@ -57,31 +63,60 @@ class MongoDbPlugin(ArchiverPlugin, ConnectorPlugin):
         self.mongodb_collection = config.get(
             'options', 'mongodb_collection', fallback='stoq'
         )
+        self.health_check_interval = config.getfloat(
+            'options', 'health_check_interval', fallback=30
+        )
+        self.bulk = config.getboolean('options', 'bulk', fallback=False)
+        self.bulk_size = config.getint('options', 'bulk_size', fallback=500)
+        self.bulk_bytes = config.getint('options', 'bulk_bytes', fallback=10485760)
+        self.bulk_interval = config.getfloat('options', 'bulk_interval', fallback=5)
+        self.bulk_max_retries = config.getint('options', 'bulk_max_retries', fallback=3)
+        self._healthy = True
+        self._health_checker: Optional[asyncio.Future] = None
+        # Buffered results as (document, size of its JSON encoding, attempts)
+        self._buffer: List[Tuple[Dict, int, int]] = []
+        self._buffer_bytes: int = 0
+        self._flusher: Optional[asyncio.Future] = None
+        if self.bulk:
+            atexit.register(self._flush_on_exit)
 
     async def save(self, response: StoqResponse) -> None:
         """
         Save results to MongoDB
 
         """
-        self._connect_mongodb()
-        result = json.loads(str(response))
+        self._connect()
+        doc = str(response)
+        result = json.loads(doc)
         result['_id'] = result['scan_id']
-        self.collection.insert_one(result)
+        if not self.bulk:
+            await self.collection.insert_one(result)
+            return
+
+        self._buffer.append((result, len(doc), 0))
+        self._buffer_bytes += len(doc)
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_periodically())
+        if len(self._buffer) >= self.bulk_size or self._buffer_bytes >= self.bulk_bytes:
+            await self._flush()
 
     async def archive(self, payload: Payload, request: Request) -> ArchiverResponse:
         """
         Archive a payload to MongoDB
 
         """
-        self._connect_gridfs()
+        self._connect()
         sha1 = get_sha1(payload.content)
-        meta = payload.payload_meta.extra_data
-        meta['_id'] = sha1
-        try:
-            with self.gridfs_db.new_file(**meta) as fp:
-                fp.write(payload.content)
-        except (DuplicateKeyError, FileExists):
-            pass
+        meta = dict(payload.payload_meta.extra_data, _id=sha1)
+        # Payloads are stored by their sha1, skip streaming the content of
+        # payloads that were already archived
+        if not await self.gridfs_files.find_one({'_id': sha1}, projection={'_id': 1}):
+            grid_in = AsyncIOMotorGridIn(self.gridfs_root, **meta)
+            try:
+                await grid_in.write(payload.content)
+                await grid_in.close()
+            except (DuplicateKeyError, FileExists):
+                pass
         return ArchiverResponse(meta)
 
     async def get(self, task: ArchiverResponse) -> Optional[Payload]:
@@ -89,40 +124,118 @@ class MongoDbPlugin(ArchiverPlugin, ConnectorPlugin):
         Retrieve archived payload from MongoDB
 
         """
-        self._connect_gridfs()
-        result = self.gridfs_db.get(task.results['_id'])
-        if result:
-            payload = result.read()
-            return Payload(payload, PayloadMeta(extra_data=task.results))
-        return None
+        self._connect()
+        try:
+            result = await self.gridfs.open_download_stream(task.results['_id'])
+        except NoFile:
+            return None
+        payload = await result.read()
+        return Payload(payload, PayloadMeta(extra_data=task.results))
 
-    def _connect(self) -> None:
+    async def _flush(self) -> None:
         """
-        Connect to a mongodb instance
+        Insert all buffered results with a single unordered insert_many,
+        requeueing results that failed with a transient error
 
         """
+        if not self._buffer:
+            return
+        docs, self._buffer, self._buffer_bytes = self._buffer, [], 0
         try:
-            self.mongo_client.server_info()
-        except (
-            ConnectionFailure,
-            NetworkTimeout,
-            ServerSelectionTimeoutError,
-            AttributeError,
-        ):
-            self.mongo_client = MongoClient(self.mongodb_uri)
-
-    def _connect_gridfs(self) -> None:
-        self._connect()
-        self.gridfs_db = GridFS(self.mongo_client.stoq_gridfs)
+            await self.collection.insert_many(
+                [doc for doc, _, _ in docs], ordered=False
+            )
+        except BulkWriteError as err:
+            failed = []
+            for error in err.details.get('writeErrors', []):
+                code = error.get('code')
+                if code == DUPLICATE_KEY:
+                    continue
+                if code in RETRY_CODES:
+                    failed.append(docs[error['index']])
+                else:
+                    self.log.error(f'Unable to save result: {error.get("errmsg")}')
+            self._requeue(failed)
+        except PyMongoError as err:
+            # Results of the batch that were already inserted fail with a
+            # duplicate key error when retried, which is ignored
+            self.log.warning(f'Unable to save {len(docs)} results: {err}')
+            self._requeue(docs)
+
+    def _requeue(self, docs: List[Tuple[Dict, int, int]]) -> None:
+        for doc, size, attempts in docs:
+            if attempts >= self.bulk_max_retries:
+                self.log.error(
+                    f'Dropping result {doc["_id"]} after {attempts + 1} attempts'
+                )
+                continue
+            self._buffer.append((doc, size, attempts + 1))
+            self._buffer_bytes += size
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.bulk_interval)
+            try:
+                await self._flush()
+            except Exception as err:
+                self.log.error(f'Unable to flush buffered results: {err}')
+
+    def _flush_on_exit(self) -> None:
+        """
+        Insert results still buffered at exit with a blocking pymongo client,
+        as motor can only run on the event loop, which has stopped by now
 
-    def _connect_mongodb(self) -> None:
-        self._connect()
-        self.mongo_db = self.mongo_client[self.mongodb_database]
-        self.collection = self.mongo_db[self.mongodb_collection]
+        """
+        if not self._buffer:
+            return
+        client = MongoClient(self.mongodb_uri)
+        collection = client[self.mongodb_database][self.mongodb_collection]
+        try:
+            collection.insert_many([doc for doc, _, _ in self._buffer], ordered=False)
+        except PyMongoError as err:
+            self.log.error(f'Unable to flush {len(self._buffer)} results: {err}')
+        finally:
+            client.close()
+        self._buffer, self._buffer_bytes = [], 0
+
+    async def _check_health(self) -> None:
+        """
+        Periodically ping the server, the client reconnects on its own so this
+        only reports when the server becomes unavailable or recovers
+
+        """
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.mongo_client.admin.command('ping')
+            except PyMongoError as err:
+                if self._healthy:
+                    self.log.warning(f'MongoDB server is unavailable: {err}')
+                self._healthy = False
+            else:
+                if not self._healthy:
+                    self.log.info('MongoDB server is available again')
+                self._healthy = True
+
+    def _connect(self) -> None:
+        """
+        Connect to a mongodb instance
+
+        """
+        if self.mongo_client is None:
+            self.mongo_client = AsyncIOMotorClient(self.mongodb_uri)
+            self.mongo_db = self.mongo_client[self.mongodb_database]
+            self.collection = self.mongo_db[self.mongodb_collection]
+            gridfs_db = self.mongo_client.stoq_gridfs
+            self.gridfs = AsyncIOMotorGridFSBucket(gridfs_db)
+            self.gridfs_root = gridfs_db.fs
+            self.gridfs_files = gridfs_db.fs.files
+        if self._health_checker is None and self.health_check_interval > 0:
+            self._health_checker = asyncio.ensure_future(self._check_health())
 
     def disconnect(self) -> None:
         """
         Disconnect from mongodb instance
 
         """
-        self.mongo_client.disconnect()
+        self.mongo_client.close()
@@ -27,18 +27,30 @@ from oletools import olevba3 as olevba
 from oletools.mraptor3 import MacroRaptor
 
 from stoq.plugins import WorkerPlugin
+from stoq.helpers import StoqConfigParser
 from stoq import Payload, Request, WorkerResponse
+from stoq_processpool import ProcessPool
 
 
 class MacroRaptorPlugin(WorkerPlugin):
     FLAGS: Dict[str, str] = {'A': 'AutoExec', 'W': 'Write', 'X': 'Execute'}
 
+    def __init__(self, config: StoqConfigParser) -> None:
+        super().__init__(config)
+
+        self._process_pool = ProcessPool(self, config)
+
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
-        results: Dict = {}
         filename = payload.results.payload_meta.extra_data.get(
             'filename', payload.results.payload_id
         )
-        vba_parser = olevba.VBA_Parser(filename=filename, data=payload.content)
+        if self._process_pool.enabled:
+            return await self._process_pool.run(payload.content, filename)
+        return self._parse(payload.content, filename)
+
+    def _parse(self, content: bytes, filename: str) -> WorkerResponse:
+        results: Dict = {}
+        vba_parser = olevba.VBA_Parser(filename=filename, data=content)
 
         if vba_parser.detect_vba_macros():
             vba_modules: List[str] = [
@@ -21,9 +21,9 @@ Scan payloads using OPSWAT MetaDefender
 
 """
 
+import asyncio
 import aiohttp
 
-from asyncio import sleep
 from json import JSONDecodeError
 from typing import Dict, List, Optional, Union, Tuple
 
@@ -33,6 +33,19 @@ from stoq.helpers import get_sha1, StoqConfigParser
 from stoq import Error, Payload, Request, WorkerResponse
 
 
+class _PendingScan:
+    """
+    A scan that has been submitted and is waiting on results
+
+    """
+
+    def __init__(self, future: asyncio.Future, due: float, interval: float) -> None:
+        self.future = future
+        self.due = due
+        self.interval = interval
+        self.attempts = 0
+
+
 class MetadefenderPlugin(WorkerPlugin):
     def __init__(self, config: StoqConfigParser) -> None:
         super().__init__(config)
@@ -43,8 +56,20 @@ class MetadefenderPlugin(WorkerPlugin):
         self.apikey = config.get('options', 'apikey', fallback=None)
         if not self.apikey:
             raise StoqPluginException('MetaDefender API Key was not provided')
-        self.delay = config.getint('options', 'delay', fallback=10)
-        self.max_attempts = config.getint('options', 'max_attempts', fallback=10)
+        self.delay = config.getfloat('options', 'delay', fallback=1)
+        self.max_delay = config.getfloat('options', 'max_delay', fallback=10)
+        self.max_attempts = config.getint('options', 'max_attempts', fallback=14)
+        self.max_connections = config.getint('options', 'max_connections', fallback=10)
+        self.hash_lookup = config.getboolean('options', 'hash_lookup', fallback=True)
+        default_hash_url = None
+        if self.opswat_url.rstrip('/').endswith('/file'):
+            default_hash_url = f'{self.opswat_url.rstrip("/")[:-5]}/hash'
+        self.hash_url = config.get('options', 'hash_url', fallback=default_hash_url)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._pending: Dict[str, _PendingScan] = {}
+        self._poller: Optional[asyncio.Future] = None
+        # Set when a scan is registered, so the poller checks it when it is due
+        self._registered: Optional[asyncio.Event] = None
 
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
         """
@@ -53,19 +78,25 @@ class MetadefenderPlugin(WorkerPlugin):
         """
 
         errors: List[Error] = []
+        self._connect()
+        sha1 = get_sha1(payload.content)
+        if self.hash_lookup and self.hash_url:
+            results = await self._lookup_hash(sha1)
+            if results:
+                return WorkerResponse(results)
         headers = {
             'apikey': self.apikey,
             'content-type': 'application/octet-stream',
             'filename': payload.results.payload_meta.extra_data.get(
-                'filename', get_sha1(payload.content).encode()
+                'filename', sha1.encode()
             ).decode(),
         }
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.post(
-                self.opswat_url, data=payload.content, headers=headers
-            ) as response:
-                content = await response.json()
-                data_id = content['data_id']
+        async with self._session.post(
+            self.opswat_url, data=payload.content, headers=headers
+        ) as response:
+            response.raise_for_status()
+            content = await response.json()
+            data_id = content['data_id']
         results, error = await self._parse_results(data_id)
         if error:
             errors.append(
@@ -77,31 +108,123 @@ class MetadefenderPlugin(WorkerPlugin):
             )
         return WorkerResponse(results, errors=errors)
 
+    async def _lookup_hash(self, sha1: str) -> Optional[Dict]:
+        """
+        Retrieve the results of a completed scan of a payload with the same hash
+
+        """
+        url = f'{self.hash_url}/{sha1}'
+        try:
+            async with self._session.get(url, headers={'apikey': self.apikey}) as r:
+                if r.status == 404:
+                    return None
+                r.raise_for_status()
+                result = await r.json()
+        except (aiohttp.ClientError, JSONDecodeError) as err:
+            self.log.debug(f'Unable to look up {sha1}: {err}')
+            return None
+        # Unknown hashes may be reported as {"<hash>": "Not Found"}
+        scan_results = result.get('scan_results') if isinstance(result, dict) else None
+        if scan_results and scan_results.get('progress_percentage') == 100:
+            return result
+        return None
+
     async def _parse_results(
         self, data_id: str
     ) -> Tuple[Union[Dict, None], Union[str, None]]:
         """
         Wait for a scan to complete and then parse the results
 
+        All in-flight scans are polled by a single poller
+
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending[data_id] = _PendingScan(
+            future, loop.time() + self.delay, self.delay
+        )
+        if self._registered is None:
+            self._registered = asyncio.Event()
+        self._registered.set()
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll())
+        try:
+            return await future
+        finally:
+            self._pending.pop(data_id, None)
+
+    async def _poll(self) -> None:
         """
-        count: int = 0
-        error: Optional[str] = None
-        await sleep(self.delay)
-        while count < self.max_attempts:
+        Check every scan that is due, backing off exponentially between
+        checks of the same scan until max_delay
+
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            self._registered.clear()
+            for data_id in [d for d, p in self._pending.items() if p.future.done()]:
+                del self._pending[data_id]
+            if not self._pending:
+                break
+            now = loop.time()
+            due = [d for d, p in self._pending.items() if p.due <= now]
+            if due:
+                await asyncio.gather(
+                    *[self._check(data_id) for data_id in due], return_exceptions=True
+                )
+                continue
+            next_due = min(p.due for p in self._pending.values())
             try:
-                url = f'{self.opswat_url}/{data_id}'
-                headers = {'apikey': self.apikey}
-                async with aiohttp.ClientSession(raise_for_status=True) as session:
-                    async with session.get(url, headers=headers) as response:
-                        result = await response.json()
-                if result['scan_results']['progress_percentage'] == 100:
-                    return result, None
-                await sleep(self.delay)
-            except (JSONDecodeError, KeyError) as err:
-                error = str(err)
-                await sleep(self.delay)
-            finally:
-                count += 1
-                if count >= self.max_attempts:
-                    error = f'Scan did not complete in time -- attempts: {count}'
-        return None, error
+                await asyncio.wait_for(
+                    self._registered.wait(), timeout=max(0, next_due - now)
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, data_id: str) -> None:
+        """
+        Check a single scan. Errors only affect the scan being checked so
+        the poller keeps running for every other scan.
+
+        """
+        # The scan may have been cancelled while other scans were checked
+        pending = self._pending.get(data_id)
+        if pending is None or pending.future.done():
+            return
+        try:
+            url = f'{self.opswat_url}/{data_id}'
+            async with self._session.get(url, headers={'apikey': self.apikey}) as r:
+                r.raise_for_status()
+                result = await r.json()
+            if result['scan_results']['progress_percentage'] == 100:
+                if not pending.future.done():
+                    pending.future.set_result((result, None))
+                return
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            JSONDecodeError,
+            KeyError,
+            TypeError,
+        ) as err:
+            self.log.debug(f'Unable to retrieve results for {data_id}: {err}')
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            if not pending.future.done():
+                pending.future.set_exception(err)
+            return
+        pending.attempts += 1
+        if pending.attempts >= self.max_attempts:
+            error = f'Scan did not complete in time -- attempts: {pending.attempts}'
+            if not pending.future.done():
+                pending.future.set_result((None, error))
+            return
+        pending.interval = min(pending.interval * 2, self.max_delay)
+        pending.due = asyncio.get_event_loop().time() + pending.interval
+
+    def _connect(self) -> None:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections)
+            )
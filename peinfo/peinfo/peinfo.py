@@ -43,11 +43,23 @@ from stoq.data_classes import (
     WorkerResponse,
 )
 from stoq.plugins import WorkerPlugin
+from stoq.helpers import StoqConfigParser
+from stoq_processpool import ProcessPool
 
 
 class PEInfoPlugin(WorkerPlugin):
+    def __init__(self, config: StoqConfigParser) -> None:
+        super().__init__(config)
+
+        self._process_pool = ProcessPool(self, config)
+
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
-        pe = self._get_pe_file(payload.content)
+        if self._process_pool.enabled:
+            return await self._process_pool.run(payload.content)
+        return self._parse(payload.content)
+
+    def _parse(self, content: bytes) -> WorkerResponse:
+        pe = self._get_pe_file(content)
 
         imports = self._get_imports(pe)
         exports = self._get_exports(pe)
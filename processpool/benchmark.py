@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+#   Copyright 2014-present PUNCH Cyber Analytics Group
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Compare worker plugin scan throughput in the event loop process against
+process pools of increasing size, using a mix of plugins and samples:
+
+    $ python benchmark.py --plugin ../peinfo/peinfo --plugin ../xyz/xyz \\
+        --workers 1 2 4 --count 200 samples/*
+
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import importlib.util
+from itertools import cycle, islice
+
+from stoq.plugins import WorkerPlugin
+from stoq.helpers import StoqConfigParser
+from stoq.data_classes import Payload, Request
+
+
+def load_plugin(plugin_dir: str, opts: dict):
+    plugin_dir = os.path.abspath(plugin_dir)
+    name = os.path.basename(plugin_dir)
+    config = StoqConfigParser()
+    config.read(os.path.join(plugin_dir, f'{name}.stoq'))
+    module_name = config.get('Core', 'Module')
+    path = os.path.join(plugin_dir, f'{module_name}.py')
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not config.has_section('options'):
+        config.add_section('options')
+    for option, value in opts.items():
+        config.set('options', option, value)
+    for obj in vars(module).values():
+        if (
+            isinstance(obj, type)
+            and issubclass(obj, WorkerPlugin)
+            and obj is not WorkerPlugin
+        ):
+            return obj(config)
+    raise ValueError(f'No worker plugin found in {path}')
+
+
+async def run(args: argparse.Namespace, workers: int) -> None:
+    opts = {
+        'process_pool': str(bool(workers)),
+        'process_pool_workers': str(workers or 1),
+        'process_pool_timeout': str(args.timeout),
+    }
+    plugins = [load_plugin(plugin_dir, opts) for plugin_dir in args.plugin]
+    samples = []
+    for path in args.samples:
+        with open(path, 'rb') as f:
+            samples.append(f.read())
+    jobs = list(islice(cycle([(p, s) for p in plugins for s in samples]), args.count))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def scan(plugin, content):
+        async with semaphore:
+            try:
+                await plugin.scan(Payload(content), Request())
+            except Exception:
+                pass
+
+    try:
+        # Start the workers before measuring
+        await asyncio.gather(*[scan(p, samples[0]) for p in plugins])
+        start = time.perf_counter()
+        await asyncio.gather(*[scan(p, s) for p, s in jobs])
+        elapsed = time.perf_counter() - start
+    finally:
+        for plugin in plugins:
+            plugin._process_pool.shutdown()
+    total = sum(len(s) for _, s in jobs)
+    mode = f'{workers} workers' if workers else 'event loop'
+    print(
+        f'{mode}: {len(jobs)} scans in {elapsed:.2f}s, '
+        f'{len(jobs) / elapsed:.1f} scans/s, {total / elapsed / 1048576:.1f} MiB/s'
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('samples', nargs='+')
+    parser.add_argument('--plugin', action='append', required=True)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--timeout', type=int, default=60)
+    args = parser.parse_args()
+    for workers in [0] + args.workers:
+        asyncio.run(run(args, workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+#   Copyright 2014-present PUNCH Cyber Analytics Group
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Overview
+========
+
+Run CPU-bound worker plugin scans in a pool of worker processes
+
+A plugin creates a `ProcessPool` from its configuration and implements a
+synchronous `_parse(content, *args)` method. When `process_pool` is enabled,
+`ProcessPool.run` places the payload in shared memory and sends it to a
+worker process, which loads the plugin from its source file and calls
+`_parse` there. Process pools require python 3.8+, older versions parse
+payloads in the calling process.
+
+"""
+
+import os
+import sys
+import asyncio
+import weakref
+import importlib.util
+import multiprocessing
+from typing import Any, Dict, List, Optional, Set, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None  # type: ignore
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None  # type: ignore
+
+from stoq.helpers import StoqConfigParser
+from stoq.exceptions import StoqPluginException
+
+
+# Plugin instance of the current worker process
+_worker_plugin = None
+
+
+def _init_worker(
+    location: Tuple[str, str, str],
+    config: Dict[str, Dict[str, str]],
+    max_memory: int,
+    pids: Any,
+) -> None:
+    """
+    Load the plugin from its source file once per worker process and apply
+    the memory cap
+
+    """
+    global _worker_plugin
+    pids.put(os.getpid())
+    if max_memory and resource is not None:
+        limit = max_memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    path, module_name, class_name = location
+    # Registered under a private name so plugin modules named after the
+    # library they wrap (e.g. lief) don't shadow it
+    name = f'{__name__}.plugins.{module_name}'
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)  # type: ignore
+    plugin_config = StoqConfigParser()
+    plugin_config.read_dict(config)
+    _worker_plugin = getattr(module, class_name)(plugin_config)
+
+
+def _scan_shared(name: str, size: int, *args) -> Any:
+    """
+    Parse a payload that the parent process placed in shared memory
+
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        content = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    return _worker_plugin._parse(content, *args)
+
+
+class _Pool:
+    """
+    A process pool, the pids of its workers and the number of scans running
+    in it that have not timed out
+
+    """
+
+    def __init__(self, executor: ProcessPoolExecutor, pids: Any) -> None:
+        self.executor = executor
+        self.pids = pids
+        self.running = 0
+        self.retired = False
+
+    def terminate(self) -> None:
+        """
+        Shut the pool down and kill any worker still stuck on a payload
+
+        """
+        self.executor.shutdown(wait=False)
+        pids: Set[int] = set()
+        while not self.pids.empty():
+            pids.add(self.pids.get())
+        for process in multiprocessing.active_children():
+            if process.pid in pids:
+                process.kill()
+
+
+def _terminate(pools: List[_Pool]) -> None:
+    while pools:
+        pools.pop().terminate()
+
+
+class ProcessPool:
+    def __init__(self, plugin: Any, config: StoqConfigParser) -> None:
+        self.enabled = config.getboolean('options', 'process_pool', fallback=False)
+        if self.enabled and shared_memory is None:
+            plugin.log.warning('process_pool requires python 3.8+, ignoring')
+            self.enabled = False
+        self.workers = config.getint('options', 'process_pool_workers', fallback=None)
+        self.timeout = config.getint('options', 'process_pool_timeout', fallback=60)
+        self.max_memory = config.getint(
+            'options', 'process_pool_max_memory', fallback=0
+        )
+        self.max_tasks = config.getint('options', 'process_pool_max_tasks', fallback=0)
+        if self.max_tasks and sys.version_info < (3, 11):
+            plugin.log.warning('process_pool_max_tasks requires python 3.11+, ignoring')
+            self.max_tasks = 0
+
+        # Workers load the plugin from its source file, so neither the plugin
+        # class nor its module need to be importable or picklable
+        plugin_class = type(plugin)
+        module_globals = plugin_class.scan.__globals__
+        self._location = (
+            module_globals['__file__'],
+            module_globals['__name__'],
+            plugin_class.__name__,
+        )
+        config_dict = {
+            section: dict(config.items(section, raw=True))
+            for section in config.sections()
+        }
+        config_dict.setdefault('options', {})['process_pool'] = 'False'
+        self._config = config_dict
+        self._pool: Optional[_Pool] = None
+        # Every pool that has not been terminated, shut down when the plugin
+        # is garbage collected or the interpreter exits
+        self._pools: List[_Pool] = []
+        self._finalizer = weakref.finalize(self, _terminate, self._pools)
+
+    async def run(self, content: bytes, *args) -> Any:
+        """
+        Run the plugin's `_parse` in a worker process
+
+        """
+        pool = self._get_pool()
+        pool.running += 1
+        size = len(content)
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            shm.buf[:size] = content
+            future = asyncio.get_event_loop().run_in_executor(
+                pool.executor, _scan_shared, shm.name, size, *args
+            )
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._retire(pool)
+            raise StoqPluginException(
+                f'Scan did not complete within {self.timeout} seconds'
+            )
+        except BrokenProcessPool as err:
+            self._retire(pool)
+            raise StoqPluginException(f'Worker process terminated abruptly: {err}')
+        finally:
+            shm.close()
+            shm.unlink()
+            pool.running -= 1
+            if pool.retired and not pool.running and pool in self._pools:
+                self._pools.remove(pool)
+                pool.terminate()
+
+    def shutdown(self) -> None:
+        """
+        Shut down every pool, killing any worker still running a scan
+
+        """
+        self._pool = None
+        _terminate(self._pools)
+
+    def _get_pool(self) -> _Pool:
+        if self._pool is None:
+            kwargs: Dict[str, Any] = {}
+            context = multiprocessing.get_context()
+            if self.max_tasks:
+                # max_tasks_per_child requires a spawn or forkserver context
+                context = multiprocessing.get_context('spawn')
+                kwargs['max_tasks_per_child'] = self.max_tasks
+            pids = context.SimpleQueue()
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(self._location, self._config, self.max_memory, pids),
+                **kwargs,
+            )
+            self._pool = _Pool(executor, pids)
+            self._pools.append(self._pool)
+        return self._pool
+
+    def _retire(self, pool: _Pool) -> None:
+        """
+        Stop sending scans to a pool with a stuck or dead worker. It is
+        terminated once the scans still running in it complete.
+
+        """
+        pool.retired = True
+        if self._pool is pool:
+            self._pool = None
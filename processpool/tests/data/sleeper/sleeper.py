@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+#   Copyright 2014-present PUNCH Cyber Analytics Group
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Overview
+========
+
+Test plugin for stoq-processpool, sleeps when a payload starts with b'sleep'
+or b'nap'
+
+"""
+
+import os
+import time
+
+from stoq.plugins import WorkerPlugin
+from stoq.helpers import StoqConfigParser
+from stoq import Payload, Request, WorkerResponse
+from stoq_processpool import ProcessPool
+
+
+class SleeperPlugin(WorkerPlugin):
+    def __init__(self, config: StoqConfigParser) -> None:
+        super().__init__(config)
+
+        self._process_pool = ProcessPool(self, config)
+
+    async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
+        if self._process_pool.enabled:
+            return await self._process_pool.run(payload.content, len(payload.content))
+        return self._parse(payload.content, len(payload.content))
+
+    def _parse(self, content: bytes, size: int) -> WorkerResponse:
+        if content.startswith(b'sleep'):
+            time.sleep(60)
+        elif content.startswith(b'nap'):
+            time.sleep(1.5)
+        return WorkerResponse(
+            {'pid': os.getpid(), 'size': size, 'content': content.decode()}
+        )
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+#   Copyright 2014-present PUNCH Cyber Analytics Group
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import asyncio
+import unittest
+import asynctest
+
+from pathlib import Path
+
+from stoq import Request, Stoq, Payload
+from stoq.data_classes import WorkerResponse
+from stoq.exceptions import StoqPluginException
+
+
+@unittest.skipIf(sys.version_info < (3, 8), 'process pools require python 3.8+')
+class TestCore(asynctest.TestCase):
+    def setUp(self) -> None:
+        self.plugin_name = 'sleeper'
+        self.base_dir = Path(os.path.realpath(__file__)).parent
+        self.plugin_dir = os.path.join(self.base_dir, 'data', self.plugin_name)
+
+    def tearDown(self) -> None:
+        pass
+
+    async def test_scan(self) -> None:
+        s = Stoq(plugin_dir_list=[self.plugin_dir])
+        plugin = s.load_plugin(self.plugin_name)
+        response = await plugin.scan(Payload(b'payload'), Request())
+        self.assertIsInstance(response, WorkerResponse)
+        self.assertNotEqual(response.results['pid'], os.getpid())
+        self.assertEqual(response.results['size'], 7)
+        self.assertEqual(response.results['content'], 'payload')
+        plugin._process_pool.shutdown()
+
+    async def test_scan_disabled(self) -> None:
+        s = Stoq(
+            plugin_dir_list=[self.plugin_dir],
+            plugin_opts={self.plugin_name: {'process_pool': False}},
+        )
+        plugin = s.load_plugin(self.plugin_name)
+        response = await plugin.scan(Payload(b'payload'), Request())
+        self.assertEqual(response.results['pid'], os.getpid())
+
+    async def test_scan_timeout(self) -> None:
+        s = Stoq(plugin_dir_list=[self.plugin_dir])
+        plugin = s.load_plugin(self.plugin_name)
+        slow = asyncio.ensure_future(plugin.scan(Payload(b'sleep'), Request()))
+        await asyncio.sleep(1)
+        # A scan still running when another times out is not interrupted
+        response = await plugin.scan(Payload(b'nap'), Request())
+        self.assertEqual(response.results['size'], 3)
+        with self.assertRaises(StoqPluginException):
+            await slow
+        response = await plugin.scan(Payload(b'payload'), Request())
+        self.assertEqual(response.results['size'], 7)
+        plugin._process_pool.shutdown()
@@ -21,14 +21,23 @@ Interact with Google Cloud Pub/Sub
 """
 
 import json
+import asyncio
 from asyncio import Queue
+from functools import partial
 from google.cloud import pubsub
-from typing import Dict, List, Optional
-from google.api_core.exceptions import DeadlineExceeded
+from google.cloud.pubsub_v1.subscriber.message import Message
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Union
 
 from stoq.helpers import StoqConfigParser
 from stoq.plugins import ConnectorPlugin, ProviderPlugin, ArchiverPlugin
-from stoq.data_classes import StoqResponse, Payload, Request, ArchiverResponse
+from stoq.data_classes import (
+    StoqResponse,
+    Payload,
+    PayloadMeta,
+    Request,
+    ArchiverResponse,
+)
 
 
 class PubSubPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
@@ -38,7 +47,17 @@ class PubSubPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
         self.publish_client = None
         self.ingest_client = None
         self.project_id = config.get('options', 'project_id')
-        self.max_messages = config.getint('options', 'max_messages', fallback=10)
+        self.max_messages = config.getint('options', 'max_messages', fallback=100)
+        self.max_bytes = config.getint('options', 'max_bytes', fallback=104857600)
+        self.publish_max_messages = config.getint(
+            'options', 'publish_max_messages', fallback=100
+        )
+        self.publish_max_bytes = config.getint(
+            'options', 'publish_max_bytes', fallback=1000000
+        )
+        self.publish_max_latency = config.getfloat(
+            'options', 'publish_max_latency', fallback=0.05
+        )
         self.publish_archive = config.getboolean(
             'options', 'publish_archive', fallback=True
         )
@@ -49,11 +68,12 @@ class PubSubPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
         self, payload: Payload, request: Request
     ) -> Optional[ArchiverResponse]:
         topic = f'projects/{self.project_id}/topics/{self.topic}'
-        self._publish_connect(topic)
+        self._publish_connect()
         future = self.publish_client.publish(
-            topic, payload.content, meta=payload.payload_meta
+            topic, payload.content, meta=str(payload.payload_meta)
         )
-        return ArchiverResponse({'msg_id': future.result()})
+        msg_id = await asyncio.wrap_future(future)
+        return ArchiverResponse({'msg_id': msg_id})
 
     async def save(self, response: StoqResponse) -> None:
         """
@@ -61,42 +81,82 @@ class PubSubPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
 
         """
         topic = f'projects/{self.project_id}/topics/{self.topic}'
-        self._publish_connect(topic)
+        self._publish_connect()
+        futures: List[Future] = []
         if self.publish_archive:
             msgs: List[Dict[str, str]] = []
             for result in response.results:
-                msgs = [{k: v} for k, v in result.archivers.items()]
+                msgs.extend({k: v} for k, v in result.archivers.items())
             for msg in msgs:
-                self.publish_client.publish(topic, json.dumps(msg).encode())
+                futures.append(
+                    self.publish_client.publish(topic, json.dumps(msg).encode())
+                )
         else:
-            self.publish_client.publish(topic, str(response).encode())
+            futures.append(self.publish_client.publish(topic, str(response).encode()))
+        # Messages are published in batches, so wait on all of them together
+        await asyncio.gather(*[asyncio.wrap_future(f) for f in futures])
 
     async def ingest(self, queue: Queue) -> None:
-        topic = f'projects/{self.project_id}/topics/{self.topic}'
         subscription = f'projects/{self.project_id}/subscriptions/{self.subscription}'
-        self._ingest_connect(subscription, topic)
+        self._ingest_connect()
         self.log.info(f'Monitoring {subscription} subscription for messages...')
-        while True:
-            try:
-                messages = self.ingest_client.pull(
-                    subscription,
-                    max_messages=self.max_messages,
-                    return_immediately=False,
-                )
-                for msg in messages.received_messages:
-                    await queue.put(json.loads(msg.message.data.decode()))
-                    self.ingest_client.acknowledge(subscription, [msg.ack_id])
-            except DeadlineExceeded:
-                self.log.debug(
-                    f'Reconnecting to {subscription} subscription for messages...'
-                )
-                self._ingest_connect(subscription, topic)
+        # Messages that have not been acknowledged count towards the flow
+        # control limits, so at most max_messages are awaiting the queue
+        flow_control = pubsub.types.FlowControl(
+            max_messages=self.max_messages, max_bytes=self.max_bytes
+        )
+        callback = partial(self._receive, queue, asyncio.get_event_loop())
+        future = self.ingest_client.subscribe(
+            subscription, callback, flow_control=flow_control
+        )
+        try:
+            await asyncio.wrap_future(future)
+        finally:
+            future.cancel()
+
+    def _receive(
+        self,
+        queue: Queue,
+        loop: asyncio.AbstractEventLoop,
+        message: Message,
+    ) -> None:
+        """
+        Streaming pull callback, called from the subscriber's thread pool
+
+        """
+        try:
+            msg = self._decode(message)
+        except ValueError as err:
+            self.log.error(f'Unable to decode message {message.message_id}: {err}')
+            message.ack()
+            return
+        future = asyncio.run_coroutine_threadsafe(queue.put(msg), loop)
+        future.add_done_callback(partial(self._queued, message))
+
+    def _queued(self, message: Message, future: Future) -> None:
+        # Acknowledgements are batched by the subscriber client
+        if future.cancelled() or future.exception():
+            message.nack()
+        else:
+            message.ack()
+
+    def _decode(self, message: Message) -> Union[Payload, Dict]:
+        meta = message.attributes.get('meta')
+        if meta:
+            # Payload published by the pubsub archiver plugin
+            meta = PayloadMeta(extra_data=json.loads(meta))
+            return Payload(message.data, payload_meta=meta)
+        return json.loads(message.data.decode())
 
-    def _publish_connect(self, topic: str) -> None:
+    def _publish_connect(self) -> None:
         if not self.publish_client:
-            self.publish_client = pubsub.PublisherClient()
+            batch_settings = pubsub.types.BatchSettings(
+                max_messages=self.publish_max_messages,
+                max_bytes=self.publish_max_bytes,
+                max_latency=self.publish_max_latency,
+            )
+            self.publish_client = pubsub.PublisherClient(batch_settings=batch_settings)
 
-    def _ingest_connect(self, subscription: str, topic: str) -> None:
-        self._publish_connect(topic)
+    def _ingest_connect(self) -> None:
         if not self.ingest_client:
             self.ingest_client = pubsub.SubscriberClient()
@@ -2,7 +2,7 @@ from setuptools import setup, find_packages
 
 setup(
     name="pubsub",
-    version="3.0.0",
+    version="3.1.0",
     author="Marcus LaFerrera (@mlaferrera)",
     url="https://github.com/PUNCH-Cyber/stoq-plugins-public",
     license="Apache License 2.0",
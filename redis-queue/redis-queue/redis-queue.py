@@ -20,13 +20,16 @@ Interact with Redis server for queuing
 
 """
 
-import time
 import json
-import redis
+import socket
+import redis.asyncio as redis
 from asyncio import Queue
-from typing import Dict, List, Optional
+from redis.exceptions import ResponseError
+from redis.commands.core import AsyncScript
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
-from stoq.helpers import dumps, StoqConfigParser
+from stoq.helpers import dumps, get_sha256, StoqConfigParser
+from stoq.exceptions import StoqPluginException
 from stoq.plugins import ConnectorPlugin, ProviderPlugin, ArchiverPlugin
 from stoq.data_classes import (
     StoqResponse,
@@ -36,10 +39,55 @@ from stoq.data_classes import (
     ArchiverResponse,
 )
 
+# Reads the metadata and buffer of a payload given its _meta, _ref and _buf
+# keys. The buffer is found through the _ref key when there is one. Returns the
+# metadata, buffer and buffer key.
+READ_PAYLOAD = """
+local meta = redis.call('GET', KEYS[1])
+local key = redis.call('GET', KEYS[2]) or KEYS[3]
+return {meta, redis.call('GET', key), key}
+"""
+
+# Deletes the keys of a payload given its _meta, _ref and _buf keys. A shared
+# buffer is only deleted once its reference count drops to zero, and a payload
+# releases its reference at most once.
+RELEASE_PAYLOAD = """
+local key = redis.call('GET', KEYS[2]) or KEYS[3]
+if redis.call('DEL', KEYS[1]) == 1 then
+    redis.call('DEL', KEYS[2])
+    if redis.call('DECR', key .. '_refs') <= 0 then
+        redis.call('DEL', key, key .. '_refs')
+    end
+end
+"""
+
+
+def _codec(name: str) -> Tuple[Callable, Callable]:
+    """
+    Return compress and decompress functions for a codec
+
+    """
+    try:
+        if name == 'zstd':
+            import zstandard
+
+            return (
+                zstandard.ZstdCompressor().compress,
+                zstandard.ZstdDecompressor().decompress,
+            )
+        elif name == 'lz4':
+            import lz4.frame
+
+            return lz4.frame.compress, lz4.frame.decompress
+    except ImportError:
+        raise StoqPluginException(f'{name} compression requires the {name} package')
+    raise StoqPluginException(f'Unsupported compression {name}, use zstd or lz4')
+
 
 class RedisPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
     def __init__(self, config: StoqConfigParser) -> None:
         super().__init__(config)
+        self.conn: Optional[redis.Redis] = None
 
         self.publish_archive = config.getboolean(
             'options', 'publish_archive', fallback=True
@@ -48,14 +96,63 @@ class RedisPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
         self.redis_port = config.getint('options', 'redis_port', fallback=6379)
         self.max_connections = config.getint('options', 'max_connections', fallback=15)
         self.redis_queue = config.get('options', 'redis_queue', fallback='stoq')
-        self._connect()
+        self.queue_backend = config.get('options', 'queue_backend', fallback='list')
+        if self.queue_backend not in ('list', 'stream'):
+            raise StoqPluginException(
+                f'Unsupported queue_backend {self.queue_backend}, use list or stream'
+            )
+        self.batch_size = config.getint('options', 'batch_size', fallback=100)
+        self.block_timeout = config.getint('options', 'block_timeout', fallback=5)
+        self.stream_group = config.get('options', 'stream_group', fallback='stoq')
+        self.stream_consumer = config.get(
+            'options', 'stream_consumer', fallback=socket.gethostname()
+        )
+        self.stream_maxlen = config.getint('options', 'stream_maxlen', fallback=0)
+        self.compression = config.get('options', 'compression', fallback=None)
+        self.compression_threshold = config.getint(
+            'options', 'compression_threshold', fallback=4096
+        )
+        self.ttl = config.getint('options', 'ttl', fallback=0)
+        self.content_addressed = config.getboolean(
+            'options', 'content_addressed', fallback=False
+        )
+        self._codecs: Dict[str, Tuple[Callable, Callable]] = {}
+        if self.compression:
+            self._codecs[self.compression] = _codec(self.compression)
+        # Not bound to a client, the pipeline is passed on each call
+        self._read_payload = AsyncScript(None, READ_PAYLOAD.encode())
+        self._release_payload = AsyncScript(None, RELEASE_PAYLOAD.encode())
 
     async def archive(
         self, payload: Payload, request: Request
     ) -> Optional[ArchiverResponse]:
-        self.conn.set(f'{payload.payload_id}_meta', str(payload.payload_meta))
-        self.conn.set(f'{payload.payload_id}_buf', payload.content)
-        self.conn.rpush(self.redis_queue, payload.payload_id)
+        self._connect()
+        content = payload.content
+        ttl = self.ttl or None
+        key = f'{payload.payload_id}_buf'
+        if self.content_addressed:
+            key = f'{{{get_sha256(content)}}}_buf'
+        if self.compression and len(content) >= self.compression_threshold:
+            # The codec is part of the key, so buffers are decompressed
+            # correctly regardless of how the provider is configured
+            content = self._codecs[self.compression][0](content)
+            key = f'{key}.{self.compression}'
+        async with self.conn.pipeline(transaction=True) as pipe:
+            pipe.set(f'{payload.payload_id}_meta', str(payload.payload_meta), ex=ttl)
+            if self.content_addressed:
+                # Identical payloads share one buffer, counting references so
+                # it is removed once the last of them has been ingested
+                pipe.set(key, content, ex=ttl, nx=True)
+                pipe.incr(f'{key}_refs')
+                if ttl:
+                    pipe.expire(key, ttl)
+                    pipe.expire(f'{key}_refs', ttl)
+            else:
+                pipe.set(key, content, ex=ttl)
+            if key != f'{payload.payload_id}_buf':
+                pipe.set(f'{payload.payload_id}_ref', key, ex=ttl)
+            self._push(pipe, payload.payload_id)
+            await pipe.execute()
         return ArchiverResponse({'msg_id': payload.payload_id})
 
     async def save(self, response: StoqResponse) -> None:
@@ -63,42 +160,133 @@ class RedisPlugin(ArchiverPlugin, ConnectorPlugin, ProviderPlugin):
         Save results or ArchiverResponse to redis
 
         """
+        self._connect()
         if self.publish_archive:
             msgs: List[Dict] = []
             for result in response.results:
-                msgs = [{k: v} for k, v in result.archivers.items()]
-            for msg in msgs:
-                self.conn.rpush(self.redis_queue, dumps(msg))
+                msgs.extend({k: v} for k, v in result.archivers.items())
+            if msgs:
+                async with self.conn.pipeline(transaction=False) as pipe:
+                    for msg in msgs:
+                        self._push(pipe, dumps(msg))
+                    await pipe.execute()
         else:
-            self.conn.set(response.scan_id, str(response))
+            await self.conn.set(response.scan_id, str(response))
 
     async def ingest(self, queue: Queue) -> None:
-        self.log.info(f'Monitoring redis queue {self.redis_queue}')
+        self._connect()
+        self.log.info(f'Monitoring redis {self.queue_backend} {self.redis_queue}')
+        if self.queue_backend == 'stream':
+            await self._ingest_stream(queue)
+        else:
+            await self._ingest_list(queue)
+
+    async def _ingest_list(self, queue: Queue) -> None:
         while True:
-            msg = self.conn.blpop(self.redis_queue, timeout=0)
+            msg = await self.conn.blpop(self.redis_queue, timeout=self.block_timeout)
             if not msg:
-                time.sleep(0.1)
                 continue
-            data = msg[1].decode()
-            payload = self.conn.get(f'{data}_buf')
-            meta = self.conn.get(f'{data}_meta')
-            if meta and payload:
+            msgs = [msg[1]]
+            if self.batch_size > 1:
+                # Pop the rest of the batch atomically in a single round trip
+                async with self.conn.pipeline(transaction=True) as pipe:
+                    pipe.lrange(self.redis_queue, 0, self.batch_size - 2)
+                    pipe.ltrim(self.redis_queue, self.batch_size - 1, -1)
+                    batch, _ = await pipe.execute()
+                msgs.extend(batch)
+            await self._enqueue(queue, [m.decode() for m in msgs])
+
+    async def _ingest_stream(self, queue: Queue) -> None:
+        try:
+            await self.conn.xgroup_create(
+                self.redis_queue, self.stream_group, id='0', mkstream=True
+            )
+        except ResponseError as err:
+            if 'BUSYGROUP' not in str(err):
+                raise
+        # Entries delivered to this consumer that were never acknowledged are
+        # handled first, then only new entries are read
+        last_id = '0'
+        while True:
+            streams = await self.conn.xreadgroup(
+                self.stream_group,
+                self.stream_consumer,
+                {self.redis_queue: last_id},
+                count=self.batch_size,
+                block=self.block_timeout * 1000,
+            )
+            entries = streams[0][1] if streams else []
+            if not entries:
+                last_id = '>'
+                continue
+            entry_ids = [entry_id for entry_id, _ in entries]
+            # Pending entries that were trimmed from the stream are returned
+            # without fields, they are only acknowledged
+            msgs = [fields[b'msg'].decode() for _, fields in entries if fields]
+            await self._enqueue(queue, msgs, entry_ids)
+
+    async def _enqueue(
+        self, queue: Queue, msgs: List[str], entry_ids: Optional[List[bytes]] = None
+    ) -> None:
+        """
+        Place messages on the provider queue. Archived payloads are read in a
+        single round trip, and only removed from redis once they are on the
+        queue, together with acknowledging their stream entries.
+
+        """
+        self._connect()
+        keys = [[f'{msg}_meta', f'{msg}_ref', f'{msg}_buf'] for msg in msgs]
+        async with self.conn.pipeline(transaction=False) as pipe:
+            for payload_keys in keys:
+                await self._read_payload(keys=payload_keys, client=pipe)
+            values = await pipe.execute()
+        found = []
+        for idx, (meta, content, key) in enumerate(values):
+            if meta and content is not None:
+                codec = key.decode().rpartition('_buf')[2].lstrip('.')
+                if codec:
+                    if codec not in self._codecs:
+                        self._codecs[codec] = _codec(codec)
+                    content = self._codecs[codec][1](content)
                 meta = json.loads(meta.decode())
                 await queue.put(
-                    Payload(payload, payload_meta=PayloadMeta(extra_data=meta))
+                    Payload(content, payload_meta=PayloadMeta(extra_data=meta))
                 )
-                self.conn.delete(f'{meta}_buf')
-                self.conn.delete(f'{meta}_meta')
-            else:
-                await queue.put(json.loads(data))
+                found.append(keys[idx])
+                continue
+            try:
+                await queue.put(json.loads(msgs[idx]))
+            except ValueError:
+                self.log.warning(
+                    f'Payload {msgs[idx]} was not found, it may have expired'
+                )
+        async with self.conn.pipeline(transaction=False) as pipe:
+            for payload_keys in found:
+                await self._release_payload(keys=payload_keys, client=pipe)
+            if entry_ids:
+                pipe.xack(self.redis_queue, self.stream_group, *entry_ids)
+            await pipe.execute()
+
+    def _push(self, pipe: redis.client.Pipeline, msg: Union[str, bytes]) -> None:
+        if self.queue_backend == 'stream':
+            pipe.xadd(
+                self.redis_queue,
+                {'msg': msg},
+                maxlen=self.stream_maxlen or None,
+                approximate=True,
+            )
+        else:
+            pipe.rpush(self.redis_queue, msg)
 
-    def _connect(self):
+    def _connect(self) -> None:
+        if self.conn is not None:
+            return
         self.conn = redis.Redis(
-            host=self.redis_host,
-            port=self.redis_port,
-            socket_keepalive=True,
-            socket_timeout=300,
             connection_pool=redis.BlockingConnectionPool(
-                max_connections=self.max_connections
-            ),
+                host=self.redis_host,
+                port=self.redis_port,
+                socket_keepalive=True,
+                socket_timeout=300,
+                max_connections=self.max_connections,
+            )
         )
@@ -21,10 +21,17 @@ Read and write data to Amazon S3
 """
 
 import boto3
+import asyncio
 import hashlib
 
 from io import BytesIO
-from typing import Optional, Dict
+from functools import partial
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple, TypeVar
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 
 from stoq.helpers import StoqConfigParser
 from stoq.plugins import ConnectorPlugin, ArchiverPlugin
@@ -36,6 +43,8 @@ from stoq.data_classes import (
     PayloadMeta,
 )
 
+T = TypeVar('T')
+
 
 class S3Plugin(ArchiverPlugin, ConnectorPlugin):
     def __init__(self, config: StoqConfigParser) -> None:
@@ -44,16 +53,39 @@ class S3Plugin(ArchiverPlugin, ConnectorPlugin):
         self.client = None
         self.access_key = config.get('options', 'access_key', fallback=None)
         self.secret_key = config.get('options', 'secret_key', fallback=None)
+        self.endpoint_url = config.get('options', 'endpoint_url', fallback=None)
+        self.region = config.get('options', 'region', fallback=None)
         self.archive_bucket = config.get('options', 'archive_bucket', fallback=None)
         self.connector_bucket = config.get('options', 'connector_bucket', fallback=None)
-        self.use_sha = config.getboolean('archiver', 'use_sha', fallback=True)
+        self.use_sha = config.getboolean('options', 'use_sha', fallback=True)
+        self.max_workers = config.getint('options', 'max_workers', fallback=8)
+        self.max_concurrency = config.getint('options', 'max_concurrency', fallback=10)
+        self.multipart_threshold = config.getint(
+            'options', 'multipart_threshold', fallback=8388608
+        )
+        self.multipart_chunksize = config.getint(
+            'options', 'multipart_chunksize', fallback=8388608
+        )
+        self.known_keys_size = config.getint(
+            'options', 'known_keys_size', fallback=100000
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.multipart_chunksize,
+            max_concurrency=self.max_concurrency,
+        )
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        # Recently archived keys, only used when keys are named by sha1
+        self._known_keys: 'OrderedDict[str, None]' = OrderedDict()
 
     async def save(self, response: StoqResponse) -> None:
         """
         Save results to S3
 
         """
-        self._upload(str(response).encode(), response.scan_id, self.connector_bucket)
+        await self._upload(
+            str(response).encode(), response.scan_id, self.connector_bucket
+        )
 
     async def archive(self, payload: Payload, request: Request) -> ArchiverResponse:
         """
@@ -63,35 +95,132 @@ class S3Plugin(ArchiverPlugin, ConnectorPlugin):
         if self.use_sha:
             filename = hashlib.sha1(payload.content).hexdigest()
             filename = f'{"/".join(list(filename[:5]))}/{filename}'
+            if not await self._exists(self.archive_bucket, filename):
+                await self._upload(payload.content, filename, self.archive_bucket)
+                self._remember(f'{self.archive_bucket}/{filename}')
         else:
             filename = payload.results.payload_id
-        self._upload(payload.content, filename, self.archive_bucket)
+            await self._upload(payload.content, filename, self.archive_bucket)
         return ArchiverResponse({'bucket': self.archive_bucket, 'path': filename})
 
     async def get(self, task: ArchiverResponse) -> Payload:
         """
         Retrieve archived payload from S3
 
+        Payloads larger than multipart_chunksize are downloaded as concurrent
+        ranged requests.
+
         """
         if not self.client:
             self._get_client()
         meta = PayloadMeta(
             extra_data={'bucket': task.results['bucket'], 'path': task.results['path']}
         )
-        content = self.client.get_object(
-            Bucket=task.results['bucket'], Key=task.results['path']
-        )['Body']
-        return Payload(content.read(), meta)
+        bucket, key = task.results['bucket'], task.results['path']
+        content, size = await self._run(partial(self._get_range, bucket, key, 0))
+        if size > len(content):
+            ranges = await asyncio.gather(
+                *[
+                    self._run(partial(self._get_range, bucket, key, start))
+                    for start in range(len(content), size, self.multipart_chunksize)
+                ]
+            )
+            content = b''.join([content, *[chunk for chunk, _ in ranges]])
+        return Payload(content, meta)
+
+    def _get_range(self, bucket: str, key: str, start: int) -> Tuple[bytes, int]:
+        """
+        Download a range of multipart_chunksize bytes of an object
+
+        Returns the range and the total size of the object
 
-    def _upload(self, payload: bytes, filename: str, bucket: str) -> None:
+        """
+        end = start + self.multipart_chunksize - 1
+        try:
+            response = self.client.get_object(
+                Bucket=bucket, Key=key, Range=f'bytes={start}-{end}'
+            )
+        except ClientError as err:
+            # Empty objects can not satisfy any range
+            if start or err.response['Error']['Code'] != 'InvalidRange':
+                raise
+            response = self.client.get_object(Bucket=bucket, Key=key)
+        content_range = response.get('ContentRange')
+        if content_range:
+            size = int(content_range.rpartition('/')[2])
+        else:
+            size = response['ContentLength']
+        return response['Body'].read(), size
+
+    async def _upload(self, payload: bytes, filename: str, bucket: str) -> None:
+        if not self.client:
+            self._get_client()
+        if len(payload) < self.multipart_threshold:
+            await self._run(
+                partial(
+                    self.client.put_object, Body=payload, Bucket=bucket, Key=filename
+                )
+            )
+        else:
+            await self._run(
+                partial(
+                    self.client.upload_fileobj,
+                    BytesIO(payload),
+                    bucket,
+                    filename,
+                    Config=self.transfer_config,
+                )
+            )
+
+    async def _exists(self, bucket: str, filename: str) -> bool:
+        """
+        Check whether an object exists, consulting recently archived keys
+        before sending a HEAD request
+
+        """
+        key = f'{bucket}/{filename}'
+        if key in self._known_keys:
+            self._known_keys.move_to_end(key)
+            return True
         if not self.client:
             self._get_client()
-        content = BytesIO(payload)
-        self.client.upload_fileobj(content, bucket, filename)
+        try:
+            await self._run(
+                partial(self.client.head_object, Bucket=bucket, Key=filename)
+            )
+        except ClientError as err:
+            # Without s3:ListBucket permission, missing keys are reported as
+            # 403 rather than 404
+            if err.response['Error']['Code'] in (
+                '403',
+                '404',
+                'AccessDenied',
+                'Forbidden',
+                'NoSuchKey',
+                'NotFound',
+            ):
+                return False
+            raise
+        self._remember(key)
+        return True
+
+    def _remember(self, key: str) -> None:
+        self._known_keys[key] = None
+        if len(self._known_keys) > self.known_keys_size:
+            self._known_keys.popitem(last=False)
+
+    async def _run(self, func: Callable[[], T]) -> T:
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func)
 
     def _get_client(self):
         self.client = boto3.client(
             's3',
             aws_access_key_id=self.access_key,
             aws_secret_access_key=self.secret_key,
+            endpoint_url=self.endpoint_url,
+            region_name=self.region,
+            # Allow each worker to run a transfer at full concurrency
+            config=Config(
+                max_pool_connections=self.max_workers * self.max_concurrency
+            ),
         )
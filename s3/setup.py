@@ -2,11 +2,13 @@ from setuptools import setup, find_packages
 
 setup(
     name="s3",
-    version="3.0.0",
+    version="3.1.0",
     author="Marcus LaFerrera (@mlaferrera)",
     url="https://github.com/PUNCH-Cyber/stoq-plugins-public",
     license="Apache License 2.0",
     description="Read and write data to Amazon S3",
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
     include_package_data=True,
+    test_suite='tests',
+    tests_require=['asynctest>=0.13.0'],
 )
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+#   Copyright 2014-present PUNCH Cyber Analytics Group
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import boto3
+import asynctest
+
+from pathlib import Path
+from botocore.stub import Stubber
+from botocore.exceptions import ClientError
+
+from stoq import Stoq, Payload, Request
+from stoq.data_classes import ArchiverResponse
+
+
+class TestCore(asynctest.TestCase):
+    def setUp(self) -> None:
+        self.plugin_name = 's3'
+        self.base_dir = Path(os.path.realpath(__file__)).parent
+        self.plugin_dir = os.path.join(self.base_dir.parent, self.plugin_name)
+        self.generic_data = b'This is a payload to archive'
+        self.bucket = 'stoq-archive'
+        self.key = '2/8/f/b/7/28fb7ab0c82d132c2f4ac0b52dce0d7471794bee'
+        self.plugin_opts = {'archive_bucket': self.bucket}
+
+    def load_plugin(self):
+        s = Stoq(
+            plugin_dir_list=[self.plugin_dir],
+            plugin_opts={self.plugin_name: self.plugin_opts},
+        )
+        plugin = s.load_plugin(self.plugin_name)
+        plugin.client = boto3.client(
+            's3',
+            aws_access_key_id='stoq',
+            aws_secret_access_key='stoq',
+            region_name='us-east-1',
+        )
+        return plugin, Stubber(plugin.client)
+
+    def expect_head(self, stubber: Stubber, status: int) -> None:
+        params = {'Bucket': self.bucket, 'Key': self.key}
+        if status == 200:
+            stubber.add_response('head_object', {}, params)
+        else:
+            stubber.add_client_error(
+                'head_object',
+                service_error_code=str(status),
+                http_status_code=status,
+                expected_params=params,
+            )
+
+    def expect_put(self, stubber: Stubber) -> None:
+        stubber.add_response(
+            'put_object',
+            {},
+            {'Body': self.generic_data, 'Bucket': self.bucket, 'Key': self.key},
+        )
+
+    async def test_archive_missing(self) -> None:
+        plugin, stubber = self.load_plugin()
+        self.expect_head(stubber, 404)
+        self.expect_put(stubber)
+        with stubber:
+            response = await plugin.archive(Payload(self.generic_data), Request())
+        stubber.assert_no_pending_responses()
+        self.assertIsInstance(response, ArchiverResponse)
+        self.assertEqual({'bucket': self.bucket, 'path': self.key}, response.results)
+
+    async def test_archive_forbidden_head(self) -> None:
+        plugin, stubber = self.load_plugin()
+        self.expect_head(stubber, 403)
+        self.expect_put(stubber)
+        with stubber:
+            await plugin.archive(Payload(self.generic_data), Request())
+        stubber.assert_no_pending_responses()
+
+    async def test_archive_exists(self) -> None:
+        plugin, stubber = self.load_plugin()
+        self.expect_head(stubber, 200)
+        with stubber:
+            await plugin.archive(Payload(self.generic_data), Request())
+            # Known keys are not checked again
+            await plugin.archive(Payload(self.generic_data), Request())
+        stubber.assert_no_pending_responses()
+
+    async def test_archive_head_error(self) -> None:
+        plugin, stubber = self.load_plugin()
+        self.expect_head(stubber, 500)
+        with stubber:
+            with self.assertRaises(ClientError):
+                await plugin.archive(Payload(self.generic_data), Request())
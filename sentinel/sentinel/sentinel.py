@@ -21,22 +21,32 @@ Send reults to Azure Sentinel (Log Analytics Workspace) using the Azure Log Anal
 """
 
 import hmac
+import gzip
+import atexit
 import base64
+import asyncio
 import hashlib
 import aiohttp
+import urllib.request
 
+from random import uniform
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 from stoq import StoqResponse
 from stoq.plugins import ConnectorPlugin
 from stoq.helpers import StoqConfigParser
 from stoq.exceptions import StoqPluginException
 
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 
 class SentinelConnector(ConnectorPlugin):
     API_RESOURCE = '/api/logs'
     CONTENT_TYPE = 'application/json'
     API_VERSION = '2016-04-01'
+    # The Data Collector API accepts at most 30 MB per post
+    MAX_POST_SIZE = 31457280
 
     def __init__(self, config: StoqConfigParser) -> None:
         super().__init__(config)
@@ -50,7 +60,24 @@ class SentinelConnector(ConnectorPlugin):
             raise StoqPluginException('workspacekey has not been defined')
 
         self.logtype = config.get('options', 'logtype', fallback='stoQ')
+        self.batch_size = config.getint('options', 'batch_size', fallback=500)
+        self.batch_bytes = min(
+            config.getint('options', 'batch_bytes', fallback=self.MAX_POST_SIZE),
+            self.MAX_POST_SIZE,
+        )
+        self.batch_interval = config.getfloat('options', 'batch_interval', fallback=5)
+        self.max_retries = config.getint('options', 'max_retries', fallback=5)
+        self.timeout = config.getfloat('options', 'timeout', fallback=30)
+        self.compress = config.getboolean('options', 'compress', fallback=True)
         self.uri = f'https://{self.workspaceid}.ods.opinsights.azure.com{self.API_RESOURCE}?api-version={self.API_VERSION}'
+        self._key = base64.b64decode(self.workspacekey)
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Encoded results waiting to be posted, and the size of the JSON array
+        # they will be posted as
+        self._buffer: List[bytes] = []
+        self._buffer_bytes: int = 2
+        self._flusher: Optional[asyncio.Future] = None
+        atexit.register(self._flush_on_exit)
 
     def build_signature(self, date, content_length):
         string_to_hash = 'POST\n'
@@ -61,26 +88,107 @@ class SentinelConnector(ConnectorPlugin):
 
         encoded_hash = base64.b64encode(
             hmac.new(
-                base64.b64decode(self.workspacekey),
-                string_to_hash.encode('utf-8'),
-                digestmod=hashlib.sha256,
+                self._key, string_to_hash.encode('utf-8'), digestmod=hashlib.sha256
             ).digest()
         ).decode()
         return f'SharedKey {self.workspaceid}:{encoded_hash}'
 
     async def save(self, response: StoqResponse) -> None:
+        """
+        Buffer a result, posting the buffered results once the batch is full
+
+        """
+        doc = str(response).encode()
+        if len(doc) + 2 > self.batch_bytes:
+            raise StoqPluginException(
+                f'Result of {len(doc)} bytes exceeds the {self.batch_bytes} byte limit'
+            )
+        if self._buffer_bytes + len(doc) + 1 > self.batch_bytes:
+            await self._flush()
+        self._buffer.append(doc)
+        self._buffer_bytes += len(doc) + 1
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_periodically())
+        if len(self._buffer) >= self.batch_size:
+            await self._flush()
+
+    def _request(self, docs: List[bytes]) -> Tuple[bytes, Dict[str, str]]:
+        """
+        Build the body and signed headers to post results as one JSON array
+
+        """
+        body = b'[' + b','.join(docs) + b']'
+        headers = {'content-type': self.CONTENT_TYPE, 'Log-Type': self.logtype}
+        if self.compress:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
         date = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
-        content = str(response)
-        content_length = len(content)
-        headers = {
-            'content-type': self.CONTENT_TYPE,
-            'Authorization': self.build_signature(date, content_length),
-            'Log-Type': self.logtype,
-            'x-ms-date': date,
-        }
-
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.post(self.uri, data=content, headers=headers) as r:
-                result = await r.text()
-                if result:
-                    self.log.debug(result)
+        headers['x-ms-date'] = date
+        headers['Authorization'] = self.build_signature(date, len(body))
+        return body, headers
+
+    async def _flush(self) -> None:
+        """
+        Post all buffered results, retrying failures with exponential backoff
+
+        """
+        if not self._buffer:
+            return
+        docs, self._buffer, self._buffer_bytes = self._buffer, [], 2
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        for attempt in range(self.max_retries + 1):
+            # Signatures are only valid for a short time, so sign each attempt
+            body, headers = self._request(docs)
+            try:
+                async with self._session.post(
+                    self.uri, data=body, headers=headers
+                ) as r:
+                    result = await r.text()
+                    if r.status < 300:
+                        if result:
+                            self.log.debug(result)
+                        return
+                    if r.status not in RETRY_STATUSES:
+                        self.log.error(
+                            f'Unable to send {len(docs)} results: {r.status} {result}'
+                        )
+                        return
+                    error = f'{r.status} {result}'
+            except aiohttp.ClientError as err:
+                error = str(err)
+            except asyncio.TimeoutError:
+                error = 'Request timed out'
+            if attempt < self.max_retries:
+                await asyncio.sleep(uniform(0, min(60, 2 ** attempt)))
+        self.log.error(
+            f'Unable to send {len(docs)} results after {self.max_retries + 1} '
+            f'attempts: {error}'
+        )
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            try:
+                await self._flush()
+            except Exception as err:
+                self.log.error(f'Unable to flush buffered results: {err}')
+
+    def _flush_on_exit(self) -> None:
+        """
+        Post anything still buffered at shutdown synchronously, the event loop
+        the session was bound to is gone by now
+
+        """
+        if not self._buffer:
+            return
+        body, headers = self._request(self._buffer)
+        request = urllib.request.Request(self.uri, data=body, headers=headers)
+        try:
+            urllib.request.urlopen(request, timeout=self.timeout).close()
+        except OSError as err:
+            # URLError, or a timeout while reading the response
+            self.log.error(f'Unable to send {len(self._buffer)} results: {err}')
+        self._buffer, self._buffer_bytes = [], 2
@@ -2,7 +2,7 @@ from setuptools import setup, find_packages
 
 setup(
     name="sentinel",
-    version="3.0.2",
+    version="3.1.0",
     author="Joe Stahl (@happy-jo)",
     url="https://github.com/PUNCH-Cyber/stoq-plugins-public",
     license="Apache License 2.0",
@@ -2,11 +2,13 @@ from setuptools import setup, find_packages
 
 setup(
     name="smtp",
-    version="3.0.8",
+    version="3.1.0",
     author="Marcus LaFerrera (@mlaferrera)",
     url="https://github.com/PUNCH-Cyber/stoq-plugins-public/v2",
     license="Apache License 2.0",
     description="SMTP Parser Worker",
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
     include_package_data=True,
+    test_suite='tests',
+    tests_require=['asynctest>=0.13.0'],
 )
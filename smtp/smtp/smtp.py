@@ -23,10 +23,10 @@ Parse SMTP sessions
 
 from email import policy
 from bs4 import UnicodeDammit  # type: ignore
-from typing import List, Dict
-from email.parser import Parser
+from typing import List, Dict, Tuple
 from urllib.parse import unquote
 from email.message import Message
+from email.parser import BytesFeedParser
 from dateutil.parser import parse as dtparse
 
 from stoq.plugins import WorkerPlugin
@@ -54,14 +54,14 @@ class SMTPPlugin(WorkerPlugin):
         )
         self.extract_iocs = config.getboolean('options', 'extract_iocs', fallback=False)
         self.ioc_keys = config.getlist('options', 'ioc_keys', fallback=ioc_keys)
+        self.feed_size = config.getint('options', 'feed_size', fallback=65536)
 
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
         message_json: Dict[str, str] = {}
         attachments: List[ExtractedPayload] = []
         errors: List[Error] = []
         ioc_content: str = ''
-        session = UnicodeDammit(payload.content).unicode_markup
-        message = Parser(policy=policy.default).parsestr(session)
+        message = self._parse_session(payload.content)
 
         try:
             # Check for invalid date string
@@ -152,25 +152,49 @@ class SMTPPlugin(WorkerPlugin):
             attachments.append(ExtractedPayload(ioc_content.encode(), ioc_meta))
         return WorkerResponse(message_json, errors=errors, extracted=attachments)
 
+    def _parse_session(self, session: bytes) -> Message:
+        # Feed the raw session to the parser in chunks so it is never decoded
+        # as a whole. Bodies and attachments stay encoded until requested.
+        parser = BytesFeedParser(policy=policy.default)
+        for offset in range(0, len(session), self.feed_size):
+            parser.feed(session[offset : offset + self.feed_size])
+        message = parser.close()
+        self._decode_headers(message)
+        return message
+
+    def _decode_headers(self, message: Message) -> None:
+        # Header values with raw 8-bit bytes are left as surrogate escapes by
+        # the bytes parser. Detect their charset with UnicodeDammit, from all
+        # of them at once, and decode them in place.
+        raw_headers: List[Tuple[Message, int, str, bytes]] = []
+        for part in message.walk():
+            for idx, (name, value) in enumerate(part._headers):
+                if not isinstance(value, str):
+                    continue
+                try:
+                    value.encode('ascii')
+                except UnicodeEncodeError:
+                    raw = value.encode('ascii', 'surrogateescape')
+                    raw_headers.append((part, idx, name, raw))
+        if not raw_headers:
+            return
+        encoding = UnicodeDammit(
+            b'\n'.join(raw for _, _, _, raw in raw_headers)
+        ).original_encoding
+        for part, idx, name, raw in raw_headers:
+            part._headers[idx] = (name, raw.decode(encoding or 'utf-8', 'replace'))
+
     def _get_body(self, message: Message, part: str) -> str:
         # Extract the e-mail body, to include HTML if available
         # We will use try and except because it is much faster than
         # validating if the objects exist.
         content = ''
-        if part == 'plain':
-            try:
-                content = UnicodeDammit(
-                    message.get_body(preferencelist=('plain')).get_payload(decode=True)
-                ).unicode_markup
-            except AttributeError:
-                pass
-        elif part == 'html':
-            try:
-                content = UnicodeDammit(
-                    message.get_body(preferencelist=('html')).get_payload(decode=True)
-                ).unicode_markup
-            except AttributeError:
-                pass
+        try:
+            content = UnicodeDammit(
+                message.get_body(preferencelist=(part,)).get_payload(decode=True)
+            ).unicode_markup
+        except AttributeError:
+            pass
         if content:
             content = unquote(content)
         return content
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+#   Copyright 2014-present PUNCH Cyber Analytics Group
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import asynctest
+
+from pathlib import Path
+
+from stoq import Request, Stoq, Payload
+from stoq.data_classes import WorkerResponse
+
+
+class TestCore(asynctest.TestCase):
+    def setUp(self) -> None:
+        self.plugin_name = 'smtp'
+        self.base_dir = Path(os.path.realpath(__file__)).parent
+        self.data_dir = os.path.join(self.base_dir, 'data')
+        self.plugin_dir = os.path.join(self.base_dir.parent, self.plugin_name)
+
+    def tearDown(self) -> None:
+        pass
+
+    async def scan(self, filename: str, **plugin_opts) -> WorkerResponse:
+        s = Stoq(
+            plugin_dir_list=[self.plugin_dir],
+            plugin_opts={self.plugin_name: plugin_opts},
+        )
+        plugin = s.load_plugin(self.plugin_name)
+        with open(f'{self.data_dir}/{filename}', 'rb') as f:
+            payload = Payload(f.read())
+        return await plugin.scan(payload, Request())
+
+    async def test_scan_8bit_headers(self) -> None:
+        response = await self.scan('cp1252_headers.eml')
+        self.assertIsInstance(response, WorkerResponse)
+        self.assertEqual('Café résumé for the équipe', response.results['subject'])
+        self.assertEqual('Jürgen Müller <jurgen@example.com>', response.results['from'])
+        self.assertIn('attached résumé', response.results['body'])
+        self.assertEqual(1, len(response.extracted))
+        self.assertEqual(b'This is an attachment', response.extracted[0].content)
+        self.assertEqual(
+            'notes.txt', response.extracted[0].payload_meta.extra_data['filename']
+        )
+
+    async def test_scan_small_feed_size(self) -> None:
+        response = await self.scan('cp1252_headers.eml', feed_size=7)
+        self.assertEqual('Café résumé for the équipe', response.results['subject'])
+        self.assertEqual(b'This is an attachment', response.extracted[0].content)
+
+    async def test_scan_extract_iocs_omit_body(self) -> None:
+        response = await self.scan(
+            'cp1252_headers.eml', omit_body=True, extract_iocs=True
+        )
+        self.assertNotIn('body', response.results)
+        iocs = response.extracted[-1].content.decode()
+        self.assertIn('192.0.2.10', iocs)
+        self.assertIn('http://example.com/cv', iocs)
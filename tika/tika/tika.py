@@ -22,27 +22,147 @@ Upload content to a Tika server for automated text extraction
 
 """
 
-import requests
+import json
+import time
+import aiohttp
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 
 from stoq.plugins import WorkerPlugin
 from stoq.helpers import StoqConfigParser
+from stoq.exceptions import StoqPluginException
 from stoq import Payload, Request, WorkerResponse, ExtractedPayload
 
+# Time in seconds to prefer other endpoints after one can't be reached
+RETRY_UNAVAILABLE = 30
+
+
+def _truncate(text: bytes, size: int) -> bytes:
+    """
+    Truncate UTF-8 text to at most size bytes without splitting a character
+
+    """
+    if len(text) <= size:
+        return bytes(text)
+    end = size
+    # Back up over the continuation bytes of a character split at the limit
+    while end > 0 and size - end < 3 and text[end] & 0xC0 == 0x80:
+        end -= 1
+    return bytes(text[:end])
+
 
 class TikaPlugin(WorkerPlugin):
     def __init__(self, config: StoqConfigParser) -> None:
         super().__init__(config)
 
-        self.tika_url = config.get(
-            'options', 'tika_url', fallback='http://localhost:9998/tika'
+        self.tika_urls = config.getlist(
+            'options', 'tika_url', fallback=['http://localhost:9998/tika']
         )
+        if not self.tika_urls:
+            raise StoqPluginException('At least one Tika URL must be provided')
+        self.rmeta = config.getboolean('options', 'rmeta', fallback=False)
+        self.max_text_size = config.getint(
+            'options', 'max_text_size', fallback=10485760
+        )
+        self.chunk_size = config.getint('options', 'chunk_size', fallback=65536)
+        self.timeout = config.getint('options', 'timeout', fallback=300)
+        self.max_connections = config.getint('options', 'max_connections', fallback=10)
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Number of requests in progress to each endpoint
+        self._outstanding: Dict[str, int] = {url: 0 for url in self.tika_urls}
+        # Time until which each unreachable endpoint is tried last
+        self._unavailable: Dict[str, float] = {}
 
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
         """
         Upload content to a Tika server for automated text extraction
 
         """
-        response = requests.put(self.tika_url, data=payload.content)
-        response.raise_for_status()
-        extracted = [ExtractedPayload(response.content)]
-        return WorkerResponse(extracted=extracted)
+        self._connect()
+        results: Optional[Dict] = None
+        extracted: List[ExtractedPayload] = []
+        if self.rmeta:
+            documents = await self._request(payload.content, self._rmeta)
+            results = {'metadata': documents}
+            for document in documents:
+                text = (document.pop('X-TIKA:content', None) or '').encode()
+                if self.max_text_size and len(text) > self.max_text_size:
+                    text = _truncate(text, self.max_text_size)
+                    results['truncated'] = True
+                if text:
+                    extracted.append(ExtractedPayload(text))
+        else:
+            text, truncated = await self._request(payload.content, self._tika)
+            extracted.append(ExtractedPayload(text))
+            if truncated:
+                results = {'truncated': True}
+        return WorkerResponse(results, extracted=extracted)
+
+    async def _request(
+        self, content: bytes, send: Callable[[str, bytes], Awaitable[Any]]
+    ) -> Any:
+        """
+        Send content to the endpoint with the fewest outstanding requests,
+        moving on to the next endpoint if one can't be connected to
+
+        """
+        now = time.monotonic()
+        endpoints = sorted(
+            self.tika_urls,
+            key=lambda url: (
+                self._unavailable.get(url, 0) > now,
+                self._outstanding[url],
+            ),
+        )
+        for attempt, url in enumerate(endpoints, 1):
+            self._outstanding[url] += 1
+            try:
+                return await send(url, content)
+            except aiohttp.ClientConnectorError as err:
+                # Only failures to connect move on, a request that timed out
+                # may have been processed and is not sent again
+                self._unavailable[url] = time.monotonic() + RETRY_UNAVAILABLE
+                if attempt == len(endpoints):
+                    raise
+                self.log.warning(f'Unable to reach Tika at {url}: {err}')
+            finally:
+                self._outstanding[url] -= 1
+
+    async def _tika(self, url: str, content: bytes) -> Tuple[bytes, bool]:
+        async with self._session.put(
+            url, data=self._stream(content), headers={'Accept': 'text/plain'}
+        ) as response:
+            response.raise_for_status()
+            text = bytearray()
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                text += chunk
+                if self.max_text_size and len(text) > self.max_text_size:
+                    return _truncate(text, self.max_text_size), True
+        return bytes(text), False
+
+    async def _rmeta(self, url: str, content: bytes) -> List[Dict]:
+        headers = {'Accept': 'application/json'}
+        if self.max_text_size:
+            headers['writeLimit'] = str(self.max_text_size)
+        async with self._session.put(
+            self._rmeta_url(url), data=self._stream(content), headers=headers
+        ) as response:
+            response.raise_for_status()
+            return json.loads(await response.read())
+
+    async def _stream(self, content: bytes) -> AsyncIterator[bytes]:
+        view = memoryview(content)
+        for offset in range(0, len(view), self.chunk_size):
+            yield view[offset : offset + self.chunk_size]
+
+    def _rmeta_url(self, url: str) -> str:
+        base = url.rstrip('/')
+        if base.endswith('/tika'):
+            base = base[: -len('/tika')]
+        return f'{base}/rmeta/text'
+
+    def _connect(self) -> None:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
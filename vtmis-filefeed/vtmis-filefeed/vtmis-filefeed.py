@@ -21,13 +21,16 @@ Process VTMIS File Feed
 
 """
 
+import os
+import bz2
 import json
+import asyncio
 import tarfile
-import requests
-from io import BytesIO
+import aiohttp
 from asyncio import Queue
+from collections import deque
 from datetime import datetime, timedelta
-from typing import Dict, List, Union, Optional
+from typing import Deque, Dict, List, Union, Optional, Set, Tuple
 
 from stoq.helpers import StoqConfigParser
 from stoq.exceptions import StoqPluginException
@@ -35,6 +38,72 @@ from stoq.plugins import ProviderPlugin, WorkerPlugin
 from stoq import Error, Payload, ExtractedPayload, Request, WorkerResponse
 
 
+class _FeedPackage:
+    """
+    Incrementally decompress a bz2 compressed tar file feed package, returning
+    the lines of each member as soon as they are complete
+
+    """
+
+    def __init__(self) -> None:
+        self._decompressor = bz2.BZ2Decompressor()
+        self._buffer = bytearray()
+        self._partial = b''
+        # Bytes remaining in the current member, and the padding following it
+        self._remaining = 0
+        self._padding = 0
+        self._regular = False
+        self._eof = False
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        while chunk and not self._eof:
+            if self._decompressor.eof:
+                self._decompressor = bz2.BZ2Decompressor()
+            self._buffer += self._decompressor.decompress(chunk)
+            chunk = self._decompressor.unused_data if self._decompressor.eof else b''
+
+        lines: List[bytes] = []
+        while not self._eof:
+            if self._remaining:
+                data = bytes(self._buffer[: self._remaining])
+                if not data:
+                    break
+                del self._buffer[: len(data)]
+                self._remaining -= len(data)
+                if self._regular:
+                    lines.extend(self._split(data, not self._remaining))
+            elif self._padding:
+                size = min(self._padding, len(self._buffer))
+                if not size:
+                    break
+                del self._buffer[:size]
+                self._padding -= size
+            elif len(self._buffer) >= tarfile.BLOCKSIZE:
+                header = bytes(self._buffer[: tarfile.BLOCKSIZE])
+                del self._buffer[: tarfile.BLOCKSIZE]
+                try:
+                    member = tarfile.TarInfo.frombuf(
+                        header, tarfile.ENCODING, 'surrogateescape'
+                    )
+                except tarfile.EOFHeaderError:
+                    self._eof = True
+                    break
+                self._regular = member.isreg()
+                self._remaining = member.size
+                self._padding = -member.size % tarfile.BLOCKSIZE
+            else:
+                break
+        return lines
+
+    def _split(self, data: bytes, final: bool) -> List[bytes]:
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        if final and self._partial:
+            lines.append(self._partial)
+            self._partial = b''
+        return [line.rstrip(b'\r') for line in lines if line.rstrip(b'\r')]
+
+
 class VTMISFileFeedPlugin(ProviderPlugin, WorkerPlugin):
     API_URL = 'https://www.virustotal.com/vtapi/v2/file/feed'
 
@@ -44,15 +113,84 @@ class VTMISFileFeedPlugin(ProviderPlugin, WorkerPlugin):
         self.apikey = config.get('options', 'apikey', fallback=None)
         self.time_since = config.get('options', 'time_since', fallback='1m')
         self.download = config.getboolean('options', 'download', fallback=False)
+        self.max_packages = config.getint('options', 'max_packages', fallback=4)
+        self.prefetch = config.getint('options', 'prefetch', fallback=1000)
+        self.chunk_size = config.getint('options', 'chunk_size', fallback=65536)
+        self.checkpoint = config.get('options', 'checkpoint', fallback=None)
+        self.max_downloads = config.getint('options', 'max_downloads', fallback=10)
+        self.max_size = config.getint('options', 'max_size', fallback=104857600)
+        self.digest_index = config.get('options', 'digest_index', fallback=None)
         if not self.apikey:
             raise StoqPluginException('VTMIS API Key does not exist')
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._download_slots: Optional[asyncio.Semaphore] = None
+        # sha1 hashes of samples already downloaded, loaded from digest_index
+        self._digests: Optional[Set[str]] = None
 
     async def ingest(self, queue: Queue) -> None:
-        for time_slice in self._generate_dates(self.time_since):
-            params = {'apikey': self.apikey, 'package': time_slice}
-            response = requests.get(self.API_URL, params=params)
-            for line in self._decompress(response.content):
-                await queue.put(Payload(line))
+        """
+        Download up to `max_packages` feed packages at a time, queueing their
+        entries in order as each package is decompressed
+
+        """
+        self._connect()
+        checkpoint = self._read_checkpoint()
+        packages = iter(
+            sorted(
+                p
+                for p in self._generate_dates(self.time_since)
+                if checkpoint is None or p > checkpoint
+            )
+        )
+        pending: Deque[Tuple[str, Queue, asyncio.Future]] = deque()
+
+        def fetch_next() -> None:
+            package = next(packages, None)
+            if package is not None:
+                lines: Queue = Queue(self.prefetch)
+                task = asyncio.ensure_future(self._fetch(package, lines))
+                pending.append((package, lines, task))
+
+        for _ in range(self.max_packages):
+            fetch_next()
+        complete = True
+        try:
+            while pending:
+                package, lines, _ = pending.popleft()
+                fetch_next()
+                while True:
+                    line = await lines.get()
+                    if line is None:
+                        break
+                    if isinstance(line, Exception):
+                        self.log.error(f'Unable to process package {package}: {line}')
+                        complete = False
+                        break
+                    await queue.put(Payload(line))
+                # Only advance the checkpoint while every earlier package has
+                # been processed, so failed packages are retried on restart
+                if complete:
+                    self._write_checkpoint(package)
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+
+    async def _fetch(self, package: str, lines: Queue) -> None:
+        loop = asyncio.get_event_loop()
+        params = {'apikey': self.apikey, 'package': package}
+        feed = _FeedPackage()
+        try:
+            async with self._session.get(self.API_URL, params=params) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    for line in await loop.run_in_executor(None, feed.feed, chunk):
+                        await lines.put(line)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            await lines.put(err)
+        else:
+            await lines.put(None)
 
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
         """
@@ -63,27 +201,88 @@ class VTMISFileFeedPlugin(ProviderPlugin, WorkerPlugin):
         errors: List[Error] = []
         results: Dict = json.loads(payload.content)
         if self.download:
-            self.log.info(f'Downloading VTMIS sample sha1: {results["sha1"]}')
-            try:
-                response = requests.get(results['link'])
-                response.raise_for_status()
-                extracted = [ExtractedPayload(response.content)]
-            except Exception as err:
-                errors.append(
-                    Error(
-                        error=f'Unable to download sample {results["sha1"]}: {err}',
-                        plugin_name=self.plugin_name,
-                        payload_id=payload.results.payload_id,
+            sha1 = results['sha1']
+            if self._is_indexed(sha1):
+                self.log.debug(f'Skipping previously downloaded sample sha1: {sha1}')
+            else:
+                try:
+                    content = await self._download(results)
+                    extracted = [ExtractedPayload(content)]
+                    self._index(sha1)
+                except Exception as err:
+                    errors.append(
+                        Error(
+                            error=f'Unable to download sample {sha1}: {err}',
+                            plugin_name=self.plugin_name,
+                            payload_id=payload.results.payload_id,
+                        )
                     )
-                )
         return WorkerResponse(results=results, errors=errors, extracted=extracted)
 
-    def _decompress(self, content):
-        tar = tarfile.open(fileobj=BytesIO(content), mode='r:bz2')
-        for member in tar.getmembers():
-            data = tar.extractfile(member.name).read()
-            for line in data.splitlines():
-                yield line
+    async def _download(self, results: Dict) -> bytes:
+        """
+        Stream a sample from VTMIS, failing once it exceeds `max_size` bytes
+
+        """
+        if self.max_size and results.get('size', 0) > self.max_size:
+            raise StoqPluginException(
+                f'Sample is {results["size"]} bytes, exceeding max_size of {self.max_size}'
+            )
+        self._connect()
+        async with self._download_slots:
+            self.log.info(f'Downloading VTMIS sample sha1: {results["sha1"]}')
+            async with self._session.get(results['link']) as response:
+                response.raise_for_status()
+                content = bytearray()
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    content += chunk
+                    if self.max_size and len(content) > self.max_size:
+                        raise StoqPluginException(
+                            f'Sample exceeds max_size of {self.max_size} bytes'
+                        )
+        return bytes(content)
+
+    def _is_indexed(self, sha1: str) -> bool:
+        if not self.digest_index:
+            return False
+        if self._digests is None:
+            self._digests = set()
+            if os.path.exists(self.digest_index):
+                with open(self.digest_index) as f:
+                    self._digests.update(line.strip() for line in f)
+        return sha1 in self._digests
+
+    def _index(self, sha1: str) -> None:
+        if not self.digest_index or sha1 in self._digests:
+            return
+        self._digests.add(sha1)
+        with open(self.digest_index, 'a') as f:
+            f.write(f'{sha1}\n')
+
+    def _read_checkpoint(self) -> Optional[str]:
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as f:
+            return f.read().strip() or None
+
+    def _write_checkpoint(self, package: str) -> None:
+        if not self.checkpoint:
+            return
+        tmp = f'{self.checkpoint}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(package)
+        os.replace(tmp, self.checkpoint)
+
+    def _connect(self) -> None:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_packages + self.max_downloads, keepalive_timeout=60
+                ),
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=300),
+            )
+        if self._download_slots is None:
+            self._download_slots = asyncio.Semaphore(self.max_downloads)
 
     def _generate_dates(self, time_since):
         """
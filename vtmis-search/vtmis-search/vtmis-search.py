@@ -21,13 +21,51 @@ Search VTMIS for sha1 hash of a payload or from results of `iocextract` plugin
 
 """
 
-import requests
-from typing import Dict, List
+import time
+import asyncio
+import aiohttp
+from json import JSONDecodeError
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 from stoq.exceptions import StoqPluginException
 from stoq.helpers import get_sha1, StoqConfigParser
 from stoq.plugins import WorkerPlugin, DispatcherPlugin
-from stoq import Payload, Request, WorkerResponse, DispatcherResponse
+from stoq import Error, Payload, Request, WorkerResponse, DispatcherResponse
+
+# Maximum number of resources the v2 API accepts in one /file/report query
+MAX_BATCH_SIZE = 25
+
+
+class _TokenBucket:
+    """
+    Allow `rate` requests per minute, with bursts of up to `rate` requests.
+    A rate of 0 does not limit requests.
+
+    """
+
+    def __init__(self, rate: int) -> None:
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.refill_rate = rate / 60
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.capacity <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.refill_rate,
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.refill_rate)
 
 
 class VTMISSearchPlugin(WorkerPlugin, DispatcherPlugin):
@@ -45,27 +83,59 @@ class VTMISSearchPlugin(WorkerPlugin, DispatcherPlugin):
         self.apikey = config.get('options', 'apikey', fallback=None)
         if not self.apikey:
             raise StoqPluginException("VTMIS API Key does not exist")
+        self.rate_limit = config.getint('options', 'rate_limit', fallback=4)
+        self.batch_size = min(
+            config.getint('options', 'batch_size', fallback=4), MAX_BATCH_SIZE
+        )
+        self.cache_ttl = config.getint('options', 'cache_ttl', fallback=3600)
+        self.cache_size = config.getint('options', 'cache_size', fallback=10000)
+        self.max_connections = config.getint(
+            'options', 'max_connections', fallback=10
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._bucket: Optional[_TokenBucket] = None
+        # Verdicts keyed by (ioc type, ioc), with the time each expires
+        self._cache: 'OrderedDict[Tuple[str, str], Tuple[float, Dict]]' = OrderedDict()
+        # Lookups currently in progress, shared by every scan requesting them
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        # sha1 lookups waiting to be sent in the next /file/report batch
+        self._file_queue: List[Tuple[str, asyncio.Future]] = []
+        self._batcher: Optional[asyncio.Future] = None
 
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
         """
         Search VTMIS for sha1 hash of a payload or from results of `iocextract` plugin
 
         """
-        results: List[Dict] = []
-        seen: Set[str] = set()
+        queries: List[Tuple[str, str]] = []
+        errors: List[Error] = []
 
         if 'iocextract' in payload.results.workers:
             for key, iocs in payload.results.workers['iocextract'].items():
                 for ioc in iocs:
-                    if key in self.ENDPOINTS and ioc not in seen:
-                        response = self._query_api(ioc, key)
-                        seen.add(ioc)
-                        results.append(response)
-        if not results:
-            sha1 = get_sha1(payload.content)
-            results = self._query_api(sha1, 'sha1')
+                    if key in self.ENDPOINTS and (key, ioc) not in queries:
+                        queries.append((key, ioc))
+        if not queries:
+            queries.append(('sha1', get_sha1(payload.content)))
 
-        return WorkerResponse(results=results)
+        self._connect()
+        results: List[Dict] = []
+        responses = await asyncio.gather(
+            *[self._lookup(key, ioc) for key, ioc in queries], return_exceptions=True
+        )
+        for (key, ioc), response in zip(queries, responses):
+            if isinstance(response, Exception):
+                errors.append(
+                    Error(
+                        error=f'Unable to query VTMIS for {key} {ioc}: {response}',
+                        plugin_name=self.plugin_name,
+                        payload_id=payload.results.payload_id,
+                    )
+                )
+            else:
+                results.append(response)
+
+        return WorkerResponse(results=results, errors=errors)
 
     async def get_dispatches(
         self, payload: Payload, request: Request
@@ -79,14 +149,112 @@ class VTMISSearchPlugin(WorkerPlugin, DispatcherPlugin):
             dr.plugin_names.append('vtmis-search')
         return dr
 
-    def _query_api(self, query: str, endpoint: str) -> Dict:
-        key, endpoint, allinfo = self.ENDPOINTS[endpoint]
-        url = f'{self.API_URL}{endpoint}'
-        params = {'apikey': self.apikey, key: query}
+    async def _lookup(self, endpoint: str, query: str) -> Dict:
+        """
+        Return the cached verdict of an ioc, or join the request already
+        retrieving it, before querying VTMIS
+
+        """
+        key = (endpoint, query)
+        cached = self._cache.get(key)
+        if cached:
+            expires, result = cached
+            if expires > time.monotonic():
+                self._cache.move_to_end(key)
+                return dict(result)
+            del self._cache[key]
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self._inflight[key] = future
+            if endpoint == 'sha1':
+                self._file_queue.append((query, future))
+                if self._batcher is None or self._batcher.done():
+                    self._batcher = asyncio.ensure_future(self._send_file_batches())
+            else:
+                asyncio.ensure_future(self._send(endpoint, [(query, future)]))
+        return dict(await asyncio.shield(future))
+
+    async def _send_file_batches(self) -> None:
+        """
+        Send queued sha1 lookups in batches of up to `batch_size`. Lookups
+        queued while waiting on the rate limit join the next batch.
+
+        """
+        while self._file_queue:
+            await self._bucket.acquire()
+            batch = self._file_queue[: self.batch_size]
+            del self._file_queue[: self.batch_size]
+            asyncio.ensure_future(self._resolve('sha1', batch))
+
+    async def _send(
+        self, endpoint: str, batch: List[Tuple[str, asyncio.Future]]
+    ) -> None:
+        await self._bucket.acquire()
+        await self._resolve(endpoint, batch)
+
+    async def _resolve(
+        self, endpoint: str, batch: List[Tuple[str, asyncio.Future]]
+    ) -> None:
+        """
+        Query VTMIS for a batch of lookups, caching and returning each verdict
+        to the scans waiting on it
+
+        """
+        try:
+            results = await self._query_api([query for query, _ in batch], endpoint)
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for (query, future), result in zip(batch, results):
+            # response_code -2 means the resource is still queued for analysis
+            if result and result.get('response_code') != -2:
+                self._cache_result((endpoint, query), result)
+            if not future.done():
+                future.set_result(result)
+
+    async def _query_api(self, queries: List[str], endpoint: str) -> List[Dict]:
+        key, path, allinfo = self.ENDPOINTS[endpoint]
+        url = f'{self.API_URL}{path}'
+        params = {'apikey': self.apikey, key: ','.join(queries)}
         if allinfo:
             params['allinfo'] = 1
-        response = requests.get(url, params=params)
-        result = response.json()
-        if result:
-            result['ioc'] = query
-        return [result]
+        async with self._session.get(url, params=params) as response:
+            if response.status == 204:
+                raise StoqPluginException('VTMIS API request rate limit exceeded')
+            response.raise_for_status()
+            try:
+                results = await response.json(content_type=None)
+            except JSONDecodeError:
+                raise StoqPluginException(
+                    f'Invalid response from VTMIS: {await response.text()}'
+                )
+        if not isinstance(results, list):
+            results = [results]
+        if len(results) != len(queries):
+            raise StoqPluginException(
+                f'VTMIS returned {len(results)} results for {len(queries)} queries'
+            )
+        for query, result in zip(queries, results):
+            if result:
+                result['ioc'] = query
+        return results
+
+    def _cache_result(self, key: Tuple[str, str], result: Dict) -> None:
+        if self.cache_ttl <= 0 or self.cache_size <= 0:
+            return
+        self._cache[key] = (time.monotonic() + self.cache_ttl, result)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _connect(self) -> None:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections)
+            )
+        if self._bucket is None:
+            self._bucket = _TokenBucket(self.rate_limit)
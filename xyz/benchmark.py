@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+#   Copyright 2014-present PUNCH Cyber Analytics Group
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Measure xyz zip parsing time on generated archives with many small members:
+
+    $ python benchmark.py --entries 10000 50000 --repeat 5
+
+"""
+
+import io
+import os
+import time
+import zipfile
+import argparse
+import importlib.util
+
+
+def load_parse_zip():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xyz', 'xyz.py')
+    spec = importlib.util.spec_from_file_location('xyz', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.parse_zip
+
+
+def build_zip(entries: int, size: int, descriptors: bool) -> bytes:
+    """
+    Build an archive of deflated members, written to a stream that can't seek
+    when descriptors are requested so every member has a data descriptor
+
+    """
+
+    class Unseekable(io.RawIOBase):
+        def __init__(self) -> None:
+            self.data = bytearray()
+
+        def writable(self) -> bool:
+            return True
+
+        def write(self, b) -> int:
+            self.data += b
+            return len(b)
+
+    out = Unseekable() if descriptors else io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as z:
+        for idx in range(entries):
+            content = (b'member %d ' % idx) * (size // 10 + 1)
+            if descriptors:
+                with z.open(f'dir/{idx}.txt', 'w') as f:
+                    f.write(content[:size])
+            else:
+                z.writestr(f'dir/{idx}.txt', content[:size])
+    return bytes(out.data) if descriptors else out.getvalue()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--entries', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    parse_zip = load_parse_zip()
+    modes = {
+        'headers': {},
+        'decompress': {'decompress_files': True},
+    }
+    for entries in args.entries:
+        for descriptors in (False, True):
+            data = build_zip(entries, args.size, descriptors)
+            for mode, kwargs in modes.items():
+                best = float('inf')
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    parse_zip(data, **kwargs)
+                    best = min(best, time.perf_counter() - start)
+                print(
+                    f'{entries} entries, descriptors={descriptors}, {mode}: '
+                    f'{best:.3f}s, {entries / best:,.0f} entries/s'
+                )
+
+
+if __name__ == '__main__':
+    main()
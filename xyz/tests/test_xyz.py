@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+#   Copyright 2014-present PUNCH Cyber Analytics Group
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import zipfile
+import asynctest
+
+from pathlib import Path
+
+from stoq import Request, Stoq, Payload
+from stoq.data_classes import WorkerResponse
+
+
+class TestCore(asynctest.TestCase):
+    def setUp(self) -> None:
+        self.plugin_name = 'xyz'
+        self.base_dir = Path(os.path.realpath(__file__)).parent
+        self.data_dir = os.path.join(self.base_dir, 'data')
+        self.plugin_dir = os.path.join(self.base_dir.parent, self.plugin_name)
+
+    def tearDown(self) -> None:
+        pass
+
+    async def scan(self, filename: str, **opts) -> WorkerResponse:
+        s = Stoq(
+            plugin_dir_list=[self.plugin_dir],
+            plugin_opts={self.plugin_name: opts},
+        )
+        plugin = s.load_plugin(self.plugin_name)
+        with open(f'{self.data_dir}/{filename}', 'rb') as f:
+            payload = Payload(f.read())
+        return await plugin.scan(payload, Request())
+
+    async def test_scan(self) -> None:
+        response = await self.scan('basic.zip')
+        self.assertIsInstance(response, WorkerResponse)
+        results = response.results
+        self.assertEqual(results['comment'], b'xyz test archive')
+        self.assertEqual(results['end_dir']['num_entries'], 3)
+        self.assertEqual(results['end_dir']['end_dir_end'], 349)
+        files = {f['filename']: f for f in results['files']}
+        self.assertEqual(list(files), ['hello.txt', 'stored.txt', 'dir/'])
+        for f in files.values():
+            self.assertEqual(f['l_filename'], f['filename'])
+            self.assertEqual(f['l_crc'], f['crc'])
+            self.assertEqual(f['decompress_crc'], f['crc_raw'])
+            self.assertEqual(f['decompress_size'], f['u_size'])
+            self.assertEqual(f['date'], '2020-01-02')
+            self.assertEqual(f['time'], '03:04:06')
+            self.assertEqual(f['local_central_header_deltas'], [])
+        hello = files['hello.txt']
+        self.assertEqual(hello['method'], 'deflate')
+        self.assertEqual(hello['u_size'], 768)
+        self.assertEqual(hello['l_data_offset'], 39)
+        self.assertEqual(hello['l_end'], 39 + hello['c_size'])
+        self.assertEqual(hello['ext_attr_posix'], '-rw-r--r--')
+        # zipfile deflates at the default level 6
+        self.assertLessEqual(hello['derived_deflate_level_min'], 6)
+        self.assertGreaterEqual(hello['derived_deflate_level_max'], 6)
+        self.assertTrue(hello['derived_deflate_match'])
+        self.assertEqual(files['stored.txt']['method'], 'store')
+        self.assertEqual(files['stored.txt']['l_offset'], hello['l_end'])
+        self.assertNotIn('derived_deflate_match', files['stored.txt'])
+
+    async def test_scan_descriptor(self) -> None:
+        response = await self.scan('descriptor.zip')
+        files = {f['filename']: f for f in response.results['files']}
+        self.assertEqual(list(files), ['streamed.txt', 'zip64.bin'])
+        for f in files.values():
+            self.assertIn('descriptor', f['flags'])
+            self.assertEqual(f['desc_sig'], 1)
+            self.assertEqual(f['desc_crc'], f['crc'])
+            self.assertEqual(f['desc_c_size'], f['c_size'])
+            self.assertEqual(f['desc_u_size'], f['u_size'])
+            self.assertEqual(f['l_end'], f['desc_offset'] + f['desc_len'])
+            self.assertEqual(f['decompress_crc'], f['crc_raw'])
+        self.assertEqual(files['streamed.txt']['desc_len'], 16)
+        self.assertTrue(files['streamed.txt']['derived_deflate_match'])
+        zip64 = files['zip64.bin']
+        self.assertEqual(zip64['l_extra_types'], ['zip64'])
+        self.assertEqual(zip64['desc_len'], 24)
+        self.assertEqual(zip64['u_size'], 256)
+        self.assertEqual(zip64['l_offset'], files['streamed.txt']['l_end'])
+
+    async def test_scan_headers_only(self) -> None:
+        response = await self.scan(
+            'basic.zip', decompress_files=False, derive_deflate_level=False
+        )
+        for f in response.results['files']:
+            self.assertNotIn('decompress_crc', f)
+            self.assertNotIn('derived_deflate_match', f)
+
+    async def test_scan_invalid_payload(self) -> None:
+        s = Stoq(plugin_dir_list=[self.plugin_dir])
+        plugin = s.load_plugin(self.plugin_name)
+        with open(f'{self.data_dir}/basic.zip', 'rb') as f:
+            truncated = f.read()[:-30]
+        for content in (b'definitely not a zip payload', truncated):
+            with self.assertRaises(zipfile.BadZipFile):
+                await plugin.scan(Payload(content), Request())
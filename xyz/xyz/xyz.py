@@ -64,12 +64,16 @@ import struct
 import zipfile
 import binascii
 import datetime
+import threading
 
 from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from stoq.plugins import WorkerPlugin
 from stoq.helpers import StoqConfigParser
 from stoq import Payload, Request, WorkerResponse
+from stoq_processpool import ProcessPool
 
 
 '''
@@ -376,43 +380,123 @@ def label_compress_flags(data, method, flags):
 '''
 
 
-def search_deflate_level(compressed_data, orig_data=None):
+DEFLATE_LEVEL_WINDOW = 65536
+DEFLATE_LEVEL_CACHE_SIZE = 4096
+
+_deflate_level_cache = OrderedDict()
+_deflate_level_cache_lock = threading.Lock()
+
+
+def _deflate_matches(compressed_data, orig_data, level, window):
+    '''
+        Re-compresses orig_data one window at a time at level, comparing the output as it is produced with the
+        same span of compressed_data. Returns False as soon as the output diverges, so a level that does not
+        match is usually rejected after its first deflate block
+
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    orig_view = memoryview(orig_data)
+    offset = 0
+    for start in range(0, len(orig_view), window):
+        recompressed_data = compressor.compress(orig_view[start : start + window])
+        if recompressed_data:
+            end = offset + len(recompressed_data)
+            if compressed_data[offset:end] != recompressed_data:
+                return False
+            offset = end
+    return compressed_data[offset:] == compressor.flush()
+
+
+def _deflate_prefix_size(compressed_data, prefix_len, window):
+    '''
+        Returns the number of bytes at the start of compressed_data that decompress to prefix_len bytes
+
+    '''
+    # deflate expands incompressible data by at most a few bytes per block, so this span of
+    # compressed_data always covers the prefix
+    span = memoryview(compressed_data)[: window + window // 4 + 64]
+    decompressor = zlib.decompressobj(-15)
+    decompressor.decompress(span, prefix_len)
+    return len(span) - len(decompressor.unconsumed_tail)
+
+
+def search_deflate_level(compressed_data, orig_data=None, window=DEFLATE_LEVEL_WINDOW):
     '''
         Tries delate levels on orig_data, which is the decompressed data, matching level to len(compressed_size)
 
         returns highest level where re-compressed data is larger or equal to compressed_size, lowest level with same compression, size at that level, and Boolean indicating exact match (connanical zlib)
 
+        Each level is first compared against compressed_data window by window, stopping at the first
+        divergence, so canonical zlib data is matched without re-compressing all of it at every level. Only
+        when no level reproduces compressed_data exactly are full re-compressions compared by size, skipping
+        levels that already compress the first window clearly smaller than compressed_data.
+
     '''
     compressed_size = len(compressed_data)
 
     if orig_data == None:
         orig_data = zlib.decompress(compressed_data)
 
-    for level in [9, 8, 7, 6, 5, 4, 3, 2, 1, 0]:
+    levels = [9, 8, 7, 6, 5, 4, 3, 2, 1, 0]
+    for idx, level in enumerate(levels):
+        if _deflate_matches(compressed_data, orig_data, level, window):
+            # check for lower compression levels that produce the same data
+            level2 = level
+            for lower in levels[idx + 1 :]:
+                if not _deflate_matches(compressed_data, orig_data, lower, window):
+                    break
+                level2 = lower
+            return level, level2, compressed_size, True
+
+    # a level that compresses the first window clearly smaller than compressed_data does will not reach
+    # compressed_size over all of orig_data, so it is skipped without re-compressing all of it
+    prefix = memoryview(orig_data)[:window]
+    check_prefix = len(prefix) < len(orig_data)
+    if check_prefix:
+        prefix_size = _deflate_prefix_size(compressed_data, len(prefix), window)
+        margin = max(16, prefix_size // 64)
+    for level in levels:
+        if check_prefix and level:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            size = len(compressor.compress(prefix))
+            # Z_SYNC_FLUSH appends an empty 4 byte stored block
+            size += len(compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+            if size + margin < prefix_size:
+                continue
         compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
-        recompressed_data = compressor.compress(orig_data)
-        recompressed_tail = compressor.flush()
-        recompressed_data = recompressed_data + recompressed_tail
-        recompressed_size = len(recompressed_data)
-        if compressed_size <= recompressed_size:
+        recompressed_data = compressor.compress(orig_data) + compressor.flush()
+        if compressed_size <= len(recompressed_data):
             break
 
     # check for lower compression levels that compress to same size
     level2 = 0
     for level2 in range(level - 1, -1, -1):
-        compressor = zlib.compressobj(level2, zlib.DEFLATED, -15)
-        recompressed_data2 = compressor.compress(orig_data)
-        recompressed_tail2 = compressor.flush()
-        recompressed_data2 = recompressed_data2 + recompressed_tail2
-        if recompressed_data != recompressed_data2:
+        if not _deflate_matches(recompressed_data, orig_data, level2, window):
             level2 = level2 + 1
             break
 
-    if recompressed_data == compressed_data:
-        same = True
-    else:
-        same = False
-    return level, level2, recompressed_size, same
+    return level, level2, len(recompressed_data), False
+
+
+def cached_search_deflate_level(
+    compressed_data, orig_data, crc, window=DEFLATE_LEVEL_WINDOW
+):
+    '''
+        search_deflate_level, memoized on the CRC and size of both the compressed and decompressed data so
+        files repeated within or across archives are only searched once
+
+    '''
+    key = (crc, len(orig_data), zlib.crc32(compressed_data), len(compressed_data))
+    with _deflate_level_cache_lock:
+        if key in _deflate_level_cache:
+            _deflate_level_cache.move_to_end(key)
+            return _deflate_level_cache[key]
+    result = search_deflate_level(compressed_data, orig_data, window)
+    with _deflate_level_cache_lock:
+        _deflate_level_cache[key] = result
+        if len(_deflate_level_cache) > DEFLATE_LEVEL_CACHE_SIZE:
+            _deflate_level_cache.popitem(last=False)
+    return result
 
 
 def label_internal_attributes(attr):
@@ -873,6 +957,23 @@ def parse_extra_data(data, type):
     return tuples, tokens
 
 
+_EXTRA_HEADER = struct.Struct("<HH")
+_CD_LENGTHS = struct.Struct("<HHHH")
+_LOCAL_HEADER = struct.Struct(zipfile.structFileHeader)
+_DESC_CRC = struct.Struct("<L")
+_DESC_SIZES = struct.Struct("<LL")
+_DESC_SIZES64 = struct.Struct("<QQ")
+_END_DIR64 = struct.Struct("<QBBHLLQQQQ")
+_LOC_DIR64 = struct.Struct("<LQL")
+_END_DIR = struct.Struct("<HHHHLLH")
+
+_SIG_CENTRAL_DIR = b"PK\x01\x02"
+_SIG_DESCRIPTOR = b"PK\x07\x08"
+_SIG_END_DIR64 = b"PK\x06\x06"
+_SIG_LOC_DIR64 = b"PK\x06\x07"
+_SIG_END_DIR = b"PK\x05\x06"
+
+
 def parse_extra_field(data):
     data_len = len(data)
     offset = 0
@@ -880,8 +981,8 @@ def parse_extra_field(data):
     field_types = []
     extra_tokens = []
     while offset <= (data_len - 4):
-        field_type = "%04x" % struct.unpack("<H", data[offset : offset + 2])[0]
-        field_len = struct.unpack("<H", data[offset + 2 : offset + 4])[0]
+        field_type, field_len = _EXTRA_HEADER.unpack_from(data, offset)
+        field_type = "%04x" % field_type
         field_data = data[offset + 4 : offset + 4 + field_len]
 
         extra_tokens.append(binascii.hexlify(data[offset : offset + 2]))
@@ -902,42 +1003,114 @@ def parse_extra_field(data):
     return field_types, fields, extra_tokens, unparsed_len
 
 
-def parse_zip(f, decompress_files=False, derive_deflate_level=False):
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+DECOMPRESS_MEMBER_LIMIT = 64 * 1024 * 1024
+DECOMPRESS_TOTAL_LIMIT = 256 * 1024 * 1024
+
+
+def decompress_member(z, entry, keep_limit=0):
+    '''
+        Streams a member out of the archive chunk by chunk, computing its CRC and size
+
+        returns the decompressed data if it fits within keep_limit bytes (otherwise None), size, CRC and any
+        error raised while decompressing
+
+    '''
+    crc = 0
+    size = 0
+    chunks = [] if keep_limit > 0 else None
+    try:
+        with z.open(entry) as member:
+            chunk = member.read(DECOMPRESS_CHUNK_SIZE)
+            while chunk:
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if chunks is not None:
+                    if size > keep_limit:
+                        chunks = None
+                    else:
+                        chunks.append(chunk)
+                chunk = member.read(DECOMPRESS_CHUNK_SIZE)
+    except Exception as e:
+        return None, 0, 0, str(e)
+    decompressed_data = b''.join(chunks) if chunks is not None else None
+    return decompressed_data, size, crc & 0xFFFFFFFF, ""
+
+
+def parse_zip(
+    data,
+    decompress_files=False,
+    derive_deflate_level=False,
+    deflate_level_window=DEFLATE_LEVEL_WINDOW,
+    deflate_level_threads=None,
+    decompress_member_limit=DECOMPRESS_MEMBER_LIMIT,
+    decompress_total_limit=DECOMPRESS_TOTAL_LIMIT,
+    deflate_level_executor=None,
+):
     '''
     return a list of dictionaries for each file in archive, archive attributes
+        data is the raw zip as a bytes-like object, or a file-like object for backwards compatibility
         decompress_files indicates that it is desired to decompress files, for example, to check size and CRC
         derive_deflate_level requires re-compressing the data upto 10 times, implies decompress_files
+        deflate_level_window is the number of bytes re-compressed between comparisons when deriving deflate levels
+        deflate_level_threads is the number of threads deriving deflate levels, zlib releases the GIL
+        deflate_level_executor is a ThreadPoolExecutor reused across calls to derive deflate levels, otherwise
+        one with deflate_level_threads is created for the call
+        decompress_member_limit and decompress_total_limit bound the decompressed data, in bytes, held for
+        deriving deflate levels. Members over either limit are only verified and have no derived level
+
+        members are streamed when decompressed, only their CRC and size are kept unless the data is
+        needed to derive the deflate level
+
+        headers are read in place from a single memoryview over data with precompiled structs, no
+        intermediate bytes objects are created while walking the archive
 
     '''
 
+    if hasattr(data, 'read'):
+        data.seek(0)
+        data = data.read()
+    mv = memoryview(data)
+    mv_len = len(mv)
+
     if derive_deflate_level:
         decompress_files = True
 
     if decompress_files:
 
         decompressed_files = []
+        decompressed_sizes = []
         decompress_errors = []
         decompressed_CRCs = []
+        decompressed_total = 0
 
-    with zipfile.ZipFile(f, 'r') as z:
+    with zipfile.ZipFile(BytesIO(data), 'r') as z:
         entries = z.infolist()
 
         if decompress_files:
             for entry in entries:
                 if entry.flag_bits & 0x0001:
                     # handle encrypted
-                    decompressed_files.append("")
+                    decompressed_files.append(None)
+                    decompressed_sizes.append(0)
                     decompress_errors.append("")
                     decompressed_CRCs.append(0)
                 else:
-                    try:
-                        decompressed_data = z.open(entry).read()
-                        decompress_errors.append("")
-                    except Exception as e:
-                        decompressed_data = ""
-                        decompress_errors.append(str(e))
+                    keep_limit = 0
+                    if derive_deflate_level and entry.compress_type == 8:
+                        keep_limit = min(
+                            decompress_member_limit,
+                            decompress_total_limit - decompressed_total,
+                        )
+                    decompressed_data, size, crc, error = decompress_member(
+                        z, entry, keep_limit
+                    )
+                    if decompressed_data is not None:
+                        decompressed_total += len(decompressed_data)
                     decompressed_files.append(decompressed_data)
-                    decompressed_CRCs.append(zlib.crc32(decompressed_data) & 0xFFFFFFFF)
+                    decompressed_sizes.append(size)
+                    decompress_errors.append(error)
+                    decompressed_CRCs.append(crc)
 
     '''
     dir(z)
@@ -954,6 +1127,7 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
 
     local_header_end = None
     cd_start = z.start_dir
+    deflate_searches = []
 
     for entry in entries:
         file = {}
@@ -1001,26 +1175,24 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
         ) = parse_extra_field(entry.extra)
 
         # get offsets for central directory, have to parse again
-        if cd_start:
+        if cd_start is not None:
             file['offset'] = cd_start
-            f.seek(cd_start + 28)
-            fname_len, extra_len, comment_len, disk_num = struct.unpack(
-                "<HHHH", f.read(8)
+            fname_len, extra_len, comment_len, disk_num = _CD_LENGTHS.unpack_from(
+                mv, cd_start + 28
             )
             file['disk_num'] = disk_num
             file['fname_len'] = fname_len
             file['extra_len'] = extra_len
             file['comment_len'] = comment_len
-            f.seek(cd_start + 46 + fname_len + extra_len + comment_len)
-            file['end'] = f.tell()
-            magic = f.read(4)
-            if magic == "PK\x01\x02":
-                cd_start = f.tell() - 4
+            cd_end = min(cd_start + 46 + fname_len + extra_len + comment_len, mv_len)
+            file['end'] = cd_end
+            if mv[cd_end : cd_end + 4] == _SIG_CENTRAL_DIR:
+                cd_start = cd_end
             else:
                 cd_start = None
 
         file['l_offset'] = entry.header_offset
-        f.seek(entry.header_offset)
+        pos = entry.header_offset
 
         if local_header_end and local_header_end != file['l_offset']:
             file['l_gap'] = file['l_offset'] - local_header_end
@@ -1028,13 +1200,12 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
         zip64 = False
 
         if decompress_files:
-            file['decompress_size'] = len(decompressed_files[len(files)])
+            file['decompress_size'] = decompressed_sizes[len(files)]
             file['decompress_crc'] = decompressed_CRCs[len(files)]
             file['decompress_errors'] = decompress_errors[len(files)]
 
-        fheader = struct.unpack(
-            zipfile.structFileHeader, f.read(zipfile.sizeFileHeader)
-        )
+        fheader = _LOCAL_HEADER.unpack_from(mv, pos)
+        pos += _LOCAL_HEADER.size
         if fheader[zipfile._FH_SIGNATURE] == zipfile.stringFileHeader:
             file['l_extract_ver'] = fheader[zipfile._FH_EXTRACT_VERSION]
             file['l_flags_raw'] = fheader[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS]
@@ -1061,14 +1232,15 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
             file['l_fname_len'] = fname_len
 
             if fname_len:
-                if file['l_flags_raw'] & 0x800:
-                    fname = f.read(fname_len).decode("utf-8", errors="replace")
-                else:
-                    fname = f.read(fname_len).decode("cp437", errors="replace")
+                encoding = "utf-8" if file['l_flags_raw'] & 0x800 else "cp437"
+                fname = str(mv[pos : pos + fname_len], encoding, errors="replace")
+                pos = min(pos + fname_len, mv_len)
             else:
                 fname = ""
             if extra_len:
-                extra = f.read(extra_len)
+                # extra field values end up in the results, keep a real bytes copy
+                extra = bytes(mv[pos : pos + extra_len])
+                pos = min(pos + extra_len, mv_len)
             else:
                 extra = b''
             (
@@ -1077,52 +1249,45 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
                 file['l_extra_tokens'],
                 file['l_extra_gap'],
             ) = parse_extra_field(extra)
+            # descriptor sizes are 8 bytes when the local header has a zip64 field
+            zip64 = 'zip64' in file['l_extra_types']
 
             # does this need adjusted in event of zip64?
             compressed_data_size = file['c_size']
 
-            file['l_data_offset'] = f.tell()
+            file['l_data_offset'] = pos
 
-            compressed_data = f.read(compressed_data_size)
+            compressed_data = mv[pos : pos + compressed_data_size]
+            pos = min(pos + compressed_data_size, mv_len)
 
             if (
                 derive_deflate_level
                 and file['method_raw'] == 8
                 and not (file['flags_raw'] & 0x0001)
+                and decompressed_files[len(files)] is not None
             ):
-                (
-                    file['derived_deflate_level_max'],
-                    file['derived_deflate_level_min'],
-                    file['derived_deflate_size'],
-                    file['derived_deflate_match'],
-                ) = search_deflate_level(
-                    compressed_data, decompressed_files[len(files)]
-                )
+                deflate_searches.append((file, compressed_data, len(files)))
 
             # descriptor
             if file['l_flags_raw'] & 0x0008:
-                file['desc_offset'] = f.tell()
+                file['desc_offset'] = pos
 
-                data = f.read(4)
                 # check for signature
-                if data == "PK\x07\x08":
+                if mv[pos : pos + 4] == _SIG_DESCRIPTOR:
                     file['desc_sig'] = 1
-                    data = f.read(4)
+                    pos += 4
                 else:
                     file['desc_sig'] = 0
-                file['desc_crc'] = "%08x" % (struct.unpack("<L", data))
-                if zip64:
-                    spec = "<QQ"
-                    slen = 16
-                else:
-                    spec = "<LL"
-                    slen = 8
-                file['desc_c_size'], file['desc_u_size'] = struct.unpack(
-                    spec, f.read(slen)
+                file['desc_crc'] = "%08x" % _DESC_CRC.unpack_from(mv, pos)
+                pos += _DESC_CRC.size
+                desc_sizes = _DESC_SIZES64 if zip64 else _DESC_SIZES
+                file['desc_c_size'], file['desc_u_size'] = desc_sizes.unpack_from(
+                    mv, pos
                 )
-                file['desc_len'] = f.tell() - file['desc_offset']
+                pos += desc_sizes.size
+                file['desc_len'] = pos - file['desc_offset']
 
-            file['l_end'] = f.tell()
+            file['l_end'] = pos
             local_header_end = file['l_end']
 
             file['l_filename'] = fname
@@ -1170,12 +1335,39 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
 
         files.append(file)
 
+    if deflate_searches:
+
+        def derive(search):
+            file, compressed_data, idx = search
+            (
+                file['derived_deflate_level_max'],
+                file['derived_deflate_level_min'],
+                file['derived_deflate_size'],
+                file['derived_deflate_match'],
+            ) = cached_search_deflate_level(
+                compressed_data,
+                decompressed_files[idx],
+                decompressed_CRCs[idx],
+                deflate_level_window,
+            )
+
+        if deflate_level_threads == 1 or len(deflate_searches) == 1:
+            for search in deflate_searches:
+                derive(search)
+        elif deflate_level_executor is not None:
+            list(deflate_level_executor.map(derive, deflate_searches))
+        else:
+            with ThreadPoolExecutor(max_workers=deflate_level_threads) as pool:
+                list(pool.map(derive, deflate_searches))
+
     archive['files'] = files
-    archive['dir_end'] = files[0]['end']
+    cd_ends = [file['end'] for file in files if 'end' in file]
+    archive['dir_end'] = cd_ends[-1] if cd_ends else archive['dir_offset']
 
     # parse the end of directory data
-    f.seek(archive["dir_end"])
-    magic = f.read(4)
+    pos = archive['dir_end']
+    magic = mv[pos : pos + 4]
+    pos += 4
 
     '''
       4.3.14  Zip64 end of central directory record
@@ -1199,11 +1391,9 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
         the starting disk number        8 bytes
         zip64 extensible data sector    (variable size)
     '''
-    if magic == "PK\x06\x06":
+    if magic == _SIG_END_DIR64:
         end_dir64 = {}
-        end_dir64['end_dir64_offset'] = f.tell() - 4
-        end_dir64_stuct = "<QBBHLLQQQQ"
-        end_dir64_data = f.read(struct.calcsize(end_dir64_stuct))
+        end_dir64['end_dir64_offset'] = pos - 4
         (
             end_dir64['end_dir64_size'],
             end_dir64['create_ver'],
@@ -1215,15 +1405,17 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
             end_dir64['num_entries'],
             end_dir64['dir_size'],
             end_dir64['dir_offset'],
-        ) = struct.unpack(end_dir64_stuct, end_dir64_data)
+        ) = _END_DIR64.unpack_from(mv, pos)
+        pos += _END_DIR64.size
         end_dir64['create_sys'] = label_create_software(end_dir64['create_sys_raw'])
-        if end_dir64['end_dir64_size'] > struct.calcsize(end_dir64_stuct):
-            end_dir64['extended'] = binascii.hexlify(
-                f.read(end_dir64['end_dir64_size'] - struct.calcsize(end_dir64_stuct))
-            )
-        end_dir64['end_dir64_end'] = f.tell()
+        if end_dir64['end_dir64_size'] > _END_DIR64.size:
+            extended_len = end_dir64['end_dir64_size'] - _END_DIR64.size
+            end_dir64['extended'] = binascii.hexlify(mv[pos : pos + extended_len])
+            pos = min(pos + extended_len, mv_len)
+        end_dir64['end_dir64_end'] = pos
         archive['end_dir64'] = end_dir64
-        magic = f.read(4)
+        magic = mv[pos : pos + 4]
+        pos += 4
 
     '''
        4.3.15 Zip64 end of central directory locator
@@ -1238,19 +1430,19 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
       total number of disks           4 bytes
     '''
 
-    if magic == "PK\x06\x07":
+    if magic == _SIG_LOC_DIR64:
         loc_dir64 = {}
-        loc_dir64['loc_dir64_offset'] = f.tell() - 4
-        loc_dir64_stuct = "<LQL"
-        loc_dir64_data = f.read(struct.calcsize(loc_dir64_stuct))
+        loc_dir64['loc_dir64_offset'] = pos - 4
         (
             loc_dir64['disk_num_end_dir64'],
             loc_dir64['end_dir64_offset'],
             loc_dir64['num_disks'],
-        ) = struct.unpack(loc_dir64_stuct, loc_dir64_data)
-        loc_dir64['loc_dir64_end'] = f.tell()
+        ) = _LOC_DIR64.unpack_from(mv, pos)
+        pos += _LOC_DIR64.size
+        loc_dir64['loc_dir64_end'] = pos
         archive['loc_dir64'] = loc_dir64
-        magic = f.read(4)
+        magic = mv[pos : pos + 4]
+        pos += 4
 
     '''
        4.3.16  End of central directory record:
@@ -1270,11 +1462,9 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
       .ZIP file comment length        2 bytes
       .ZIP file comment       (variable size)
     '''
-    if magic == "PK\x05\x06":
+    if magic == _SIG_END_DIR:
         end_directory = {}
-        end_directory['end_dir_offset'] = f.tell() - 4
-        end_directory_stuct = "<HHHHLLH"
-        end_directory_data = f.read(struct.calcsize(end_directory_stuct))
+        end_directory['end_dir_offset'] = pos - 4
         (
             end_directory['disk_num'],
             end_directory['disk_num_dir'],
@@ -1283,12 +1473,15 @@ def parse_zip(f, decompress_files=False, derive_deflate_level=False):
             end_directory['dir_size'],
             end_directory['dir_offset'],
             end_directory['comment_len'],
-        ) = struct.unpack(end_directory_stuct, end_directory_data)
+        ) = _END_DIR.unpack_from(mv, pos)
+        pos += _END_DIR.size
         if end_directory['comment_len']:
-            end_directory['comment'] = f.read(end_directory['comment_len']).decode(
-                "utf8", errors="replace"
+            comment_end = pos + end_directory['comment_len']
+            end_directory['comment'] = str(
+                mv[pos:comment_end], "utf8", errors="replace"
             )
-        end_directory['end_dir_end'] = f.tell()
+            pos = min(comment_end, mv_len)
+        end_directory['end_dir_end'] = pos
         archive['end_dir'] = end_directory
 
     return archive
@@ -1303,11 +1496,39 @@ class Xyz(WorkerPlugin):
         self.derive_deflate_level = config.getboolean(
             'options', 'derive_deflate_level', fallback=True
         )
+        self.deflate_level_window = config.getint(
+            'options', 'deflate_level_window', fallback=DEFLATE_LEVEL_WINDOW
+        )
+        self.deflate_level_threads = config.getint(
+            'options', 'deflate_level_threads', fallback=None
+        )
+        self.decompress_member_limit = config.getint(
+            'options', 'decompress_member_limit', fallback=DECOMPRESS_MEMBER_LIMIT
+        )
+        self.decompress_total_limit = config.getint(
+            'options', 'decompress_total_limit', fallback=DECOMPRESS_TOTAL_LIMIT
+        )
+        # Threads are only started once deflate levels are derived, so a plugin
+        # that sends scans to its process pool never starts any
+        self._deflate_level_executor = ThreadPoolExecutor(
+            max_workers=self.deflate_level_threads
+        )
+        self._process_pool = ProcessPool(self, config)
 
     async def scan(self, payload: Payload, request: Request) -> WorkerResponse:
+        if self._process_pool.enabled:
+            return await self._process_pool.run(payload.content)
+        return self._parse(payload.content)
+
+    def _parse(self, content: bytes) -> WorkerResponse:
         results = parse_zip(
-            BytesIO(payload.content),
+            content,
             decompress_files=self.decompress_files,
             derive_deflate_level=self.derive_deflate_level,
+            deflate_level_window=self.deflate_level_window,
+            deflate_level_threads=self.deflate_level_threads,
+            decompress_member_limit=self.decompress_member_limit,
+            decompress_total_limit=self.decompress_total_limit,
+            deflate_level_executor=self._deflate_level_executor,
         )
         return WorkerResponse(results)